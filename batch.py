@@ -0,0 +1,147 @@
+"""Runs many PSIL programs at once on a pool of worker processes or threads.
+
+Each program gets its own Interpreter in one of the workers. Workers import
+the interpreter and its builtins once, when the pool starts, and keep their
+bytecode.cache between the programs they run. Thread workers all share one
+process, its builtins and its cache (the interpreters never write into what
+they share, see psil.Interpreter). What a program prints is captured and sent
+back with its timing and any error when it finishes, results come back in the
+order the programs finish in (psil.py --batch)."""
+
+import concurrent.futures, io, multiprocessing, os, signal, sys, threading, \
+       time
+
+import psil
+
+class Timeout(Exception):
+    """Raised in a worker when a program runs longer than allowed."""
+
+class Result:
+    """What running one program gave.
+
+    error is None if the program ran to the end, otherwise the exception it
+    raised as "Type: message". timed_out is set when that was a Timeout."""
+    def __init__(self, path):
+        self.path = path
+        self.output = ""
+        self.error = None
+        self.timed_out = False
+        self.wall = 0.0
+        self.ops = 0
+
+def manifest(path):
+    """Program paths listed in the file at path.
+
+    One path a line, relative ones are relative to the manifest. Blank lines
+    and lines starting with # are skipped."""
+    directory = os.path.dirname(path)
+    paths = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(os.path.join(directory, line))
+    return paths
+
+## set in each worker by initialize
+_timeout = None
+_library = None # the names of an image, for every program
+
+def _expire(signum, frame):
+    raise Timeout("Ran longer than {} seconds".format(_timeout))
+
+def initialize(timeout=None, image=None):
+    """Set up a worker process, run once before its first program.
+    
+    The worker already has this module, so psil and stdlib with its builtins,
+    imported by then. image is the path of an image (see image.py) whose 
+    names every program starts with, it is loaded here once."""
+    global _timeout, _library
+    _timeout = timeout
+    if image is not None:
+        import image as images
+        _library = images.load(image)
+    if timeout and hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _expire)
+
+def run(path):
+    """Run the program at path, return its Result.
+    
+    Programs are only timed out in worker processes, not in threads."""
+    result = Result(path)
+    output = io.StringIO()
+    interpreter = None
+    timed = _timeout and hasattr(signal, "setitimer") and \
+            threading.current_thread() is threading.main_thread()
+    start = time.perf_counter()
+    try:
+        with open(path, "r") as f:
+            interpreter = psil.Interpreter(f, output=output, 
+                                           library=_library)
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, _timeout)
+        try:
+            interpreter.run()
+        finally:
+            if timed:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except Exception as e:
+        result.error = "{}: {}".format(type(e).__name__, e)
+        result.timed_out = isinstance(e, Timeout)
+    result.wall = time.perf_counter() - start
+    result.output = output.getvalue()
+    if interpreter is not None:
+        result.ops = interpreter.ops
+    return result
+
+def execute(paths, jobs=None, timeout=None, threads=False, image=None):
+    """Run the programs at paths on jobs worker processes, or threads.
+
+    jobs defaults to the number of processors. Generates the Results as the
+    programs finish. timeout only applies to processes. The programs start 
+    with the names in the image at path image, if given."""
+    if threads:
+        initialize(None, image) # the threads share this process's globals
+        jobs = jobs or os.cpu_count()
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(run, path) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        return
+    with multiprocessing.Pool(jobs, initialize, (timeout, image)) as pool:
+        for result in pool.imap_unordered(run, paths):
+            yield result
+
+def report(result, out=None):
+    """Print result: a header line, then the program's output and error."""
+    out = out or sys.stdout
+    if result.error is None:
+        status = "ok"
+    elif result.timed_out:
+        status = "TIMEOUT"
+    else:
+        status = "FAILED"
+    out.write("== {} {} {:.3f}s {} ops\n".format(result.path, status,
+                                                 result.wall, result.ops))
+    out.write(result.output)
+    if result.error is not None:
+        out.write(result.error+"\n")
+    out.flush()
+
+def main(paths, jobs=None, timeout=None, out=None, threads=False, 
+         image=None):
+    """Run paths, reporting each result as it comes in and then a summary.
+
+    Returns the number of programs that failed or timed out."""
+    out = out or sys.stdout
+    start = time.perf_counter()
+    failed = timed_out = 0
+    for result in execute(paths, jobs, timeout, threads, image):
+        report(result, out)
+        if result.timed_out:
+            timed_out += 1
+        elif result.error is not None:
+            failed += 1
+    out.write("== {} programs, {} failed, {} timed out, {:.3f}s\n".format(
+        len(paths), failed, timed_out, time.perf_counter() - start))
+    return failed + timed_out
@@ -0,0 +1,309 @@
+#! /usr/bin/python3
+"""Benchmarks for the PSIL interpreter.
+
+Runs the programs in benchmarks/ with psil.Interpreter, and their source with 
+parse.parse alone, reporting instructions per second, wall time, peak memory 
+and allocated blocks for each. Results can be saved as a baseline, later runs
+are compared against it and slowdowns or growth past a threshold are flagged.
+
+The programs never finish on their own, they call the tick builtin that the 
+runner adds, which stops the program after a set number of calls.
+
+bench.py --check runs the example programs next to it instead (EXAMPLES) 
+with every backend, failing when one ends in an error or the backends do 
+not print the same."""
+
+import argparse, contextlib, gc, io, json, os, sys, time, tracemalloc
+
+import bytecode, data, parse, psil
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                         "benchmarks")
+BASELINE = os.path.join(DIRECTORY, "baseline.json")
+
+## name -> number of ticks the program runs for. The large source is built by 
+## large_source instead of being read from a file, and runs to completion.
+BENCHMARKS = {
+    "recursion": 20000,
+    "unwind": 10,
+    "tailcall": 50000,
+    "calls": 20000,
+    "arith": 20000,
+    "records": 10000,
+    "strings": 20000,
+    "large": None,
+    }
+    
+## example programs run by --check, which must run to the end the same way
+## in every backend: the bundled examples, then short ones for folds, the 
+## builtins running code inline, memo and rebound builtins
+EXAMPLES = ("f1rst.psil", "test.psil", "folds.psil", "control.psil",
+            "memo.psil", "rebind.psil")
+
+## metrics where a bigger number is worse, with how they are printed
+METRICS = (("wall", "{:.4f}"), ("peak", "{:d}"), ("blocks", "{:d}"))
+
+class Done(Exception):
+    """Raised by Tick to end a benchmark program."""
+    
+class Tick(data.LLCode):
+    """Counts calls, ending the program after limit of them."""
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.count = 0
+        
+    def __call__(self, state):
+        self.count += 1
+        if self.count >= self.limit:
+            raise Done()
+            
+class Sink(io.TextIOBase):
+    """Stands in for stdout, keeping only the number of characters written."""
+    def __init__(self):
+        self.written = 0
+        
+    def writable(self):
+        return True
+        
+    def write(self, text):
+        self.written += len(text)
+        return len(text)
+        
+def letters(n):
+    """Spell n in letters, names can not have digits."""
+    name = ""
+    while True:
+        n, digit = divmod(n, 26)
+        name += "abcdefghijklmnopqrstuvwxyz"[digit]
+        if not n:
+            return name
+            
+def large_source(blocks=2000):
+    """PSIL source of many small definitions and calls, about 200 bytes a block.
+    
+    Has comments, strings, integers, floats and nested code literals, so it 
+    covers everything the lexer does."""
+    parts = []
+    for n in range(blocks):
+        parts.append(
+            "# block {0}: two definitions and a call #\n"
+            "(f{1} {{\n"
+            "    ((b swap) def) ((a swap) def)\n"
+            "    (\"block {0}\" out)\n"
+            "    (((a b mul) {0} add) 3 mod)\n"
+            "}} def)\n"
+            "(g{1} {{((x swap) def) ((x 1.5 mul) (x 2 sub) f{1})}} def)\n"
+            "({0} g{1})\n".format(n, letters(n)))
+    return "".join(parts)
+    
+def source(name, blocks=2000):
+    if name == "large":
+        return large_source(blocks)
+    with open(os.path.join(DIRECTORY, name+".psil"), "r") as f:
+        return f.read()
+        
+def interpret(text, ticks, reference=False, closures=False):
+    """Run text to completion, return the Interpreter it ran in."""
+    interpreter = psil.Interpreter(io.StringIO(text), reference=reference,
+                                   closures=closures)
+    if ticks is not None:
+        interpreter.env.bind(Tick(ticks), "tick")
+    try:
+        interpreter.run()
+    except Done:
+        pass
+    return interpreter
+    
+def parse_all(text):
+    """Parse text and every code literal in it, return the instruction count.
+    
+    The interpreter parses literal bodies when they are first run, here all of
+    them are parsed right away, without the code cache."""
+    count = 0
+    bodies = [(text, 0, None)]
+    while bodies:
+        for inst in parse.parse(*bodies.pop()):
+            count += 1
+            if isinstance(inst, parse.Push) and \
+               isinstance(inst.value, data.Code):
+                bodies.append(inst.value.body())
+    return count
+    
+def measure(run):
+    """Time run() and count its memory use, run returns the instruction count.
+    
+    Memory is measured in a second run under tracemalloc, which slows down 
+    everything it traces. Compiled code is dropped before each run so all of 
+    them do the same work."""
+    results = {}
+    with contextlib.redirect_stdout(Sink()):
+        bytecode.cache.clear()
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        ops = run()
+        results["wall"] = time.perf_counter() - start
+        results["blocks"] = sys.getallocatedblocks() - blocks
+        
+        bytecode.cache.clear()
+        gc.collect()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        run()
+        results["peak"] = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    results["ops"] = ops
+    results["rate"] = ops/results["wall"] if results["wall"] else 0.0
+    return results
+    
+def benchmark(name, modes, repeat=3, blocks=2000):
+    """Run one benchmark in each of modes, keeping the fastest of repeat runs.
+    
+    modes are "bytecode", "closures", "reference" (the ways the interpreter
+    runs programs) and "parse".
+    Returns a dict of mode -> metrics."""
+    text = source(name, blocks)
+    ticks = BENCHMARKS[name]
+    runs = {
+        "bytecode": lambda: interpret(text, ticks).ops,
+        "closures": lambda: interpret(text, ticks, closures=True).ops,
+        "reference": lambda: interpret(text, ticks, reference=True).ops,
+        "parse": lambda: parse_all(text),
+        }
+    results = {}
+    for mode in modes:
+        best = None
+        for _ in range(repeat):
+            result = measure(runs[mode])
+            if best is None or result["wall"] < best["wall"]:
+                best = result
+        results[mode] = best
+    return results
+    
+def check(names=EXAMPLES):
+    """Run the example programs with every backend, return the problems 
+    found as a list of strings, empty if there were none."""
+    problems = []
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in names:
+        outputs = {}
+        for mode in ("bytecode", "closures", "reference"):
+            with open(os.path.join(directory, name), "r") as f:
+                text = f.read()
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output):
+                    psil.Interpreter(io.StringIO(text),
+                                     reference=mode == "reference",
+                                     closures=mode == "closures").run()
+            except Exception as e:
+                problems.append("{} {}: {}: {}".format(
+                    name, mode, type(e).__name__, e))
+                continue
+            outputs[mode] = output.getvalue()
+        if len(set(outputs.values())) > 1:
+            problems.append(name+": backends printed different output")
+    return problems
+    
+def compare(results, baseline, threshold):
+    """List the (name, mode, metric, old, new) that regressed past threshold."""
+    regressions = []
+    for name, modes in results.items():
+        for mode, result in modes.items():
+            old = baseline.get(name, {}).get(mode)
+            if old is None:
+                continue
+            for metric, _ in METRICS:
+                if result[metric] > old[metric]*(1 + threshold):
+                    regressions.append((name, mode, metric, old[metric], 
+                                        result[metric]))
+    return regressions
+    
+def report(results, baseline=None):
+    """Table of results, with the change against baseline where there is one.
+    """
+    lines = ["{:<10} {:<9} {:>10} {:>9} {:>11} {:>11} {:>8}".format(
+        "benchmark", "mode", "ops", "wall s", "ops/s", "peak bytes", "blocks")]
+    for name, modes in results.items():
+        for mode, r in modes.items():
+            line = "{:<10} {:<9} {:>10d} {:>9.4f} {:>11.0f} {:>11d} {:>8d}"\
+                .format(name, mode, r["ops"], r["wall"], r["rate"], r["peak"],
+                        r["blocks"])
+            old = (baseline or {}).get(name, {}).get(mode)
+            if old is not None and old["wall"]:
+                line += "  {:+.1%} wall".format(r["wall"]/old["wall"] - 1)
+            lines.append(line)
+    return "\n".join(lines)
+    
+    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the PSIL "
+                                                 "interpreter and parser.")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="benchmarks to run (default all of: "+
+                             ", ".join(BENCHMARKS)+")")
+    parser.add_argument("--modes", default="bytecode,parse",
+                        help="comma separated, from bytecode, closures, "
+                             "reference and parse (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each benchmark, the fastest one counts "
+                             "(default %(default)s)")
+    parser.add_argument("--blocks", type=int, default=2000,
+                        help="size of the large source, in blocks of about "
+                             "200 bytes (default %(default)s)")
+    parser.add_argument("--baseline", default=BASELINE, metavar="FILE",
+                        help="baseline results (default %(default)s)")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="run the example programs with every backend "
+                             "instead, failing on errors")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative growth of wall time, peak memory or "
+                             "blocks flagged as a regression "
+                             "(default %(default)s)")
+    args = parser.parse_args()
+    
+    if args.check:
+        problems = check()
+        for problem in problems:
+            print("FAILED "+problem)
+        if not problems:
+            print("checked "+", ".join(EXAMPLES))
+        sys.exit(1 if problems else 0)
+        
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark "+name)
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in ("bytecode", "closures", "reference", "parse"):
+            parser.error("unknown mode "+mode)
+            
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+            
+    results = {}
+    for name in names:
+        results[name] = benchmark(name, modes, args.repeat, args.blocks)
+    print(report(results, baseline))
+    
+    status = 0
+    if baseline is not None and not args.save:
+        regressions = compare(results, baseline, args.threshold)
+        for name, mode, metric, old, new in regressions:
+            print("REGRESSION {} {} {}: {} -> {}".format(name, mode, metric, 
+                                                        old, new))
+        status = 1 if regressions else 0
+    if args.save:
+        saved = baseline or {}
+        for name, modes in results.items():
+            saved.setdefault(name, {}).update(modes)
+        with open(args.baseline, "w") as f:
+            json.dump(saved, f, indent=4, sort_keys=True)
+        print("saved baseline to "+args.baseline)
+    sys.exit(status)
@@ -0,0 +1,211 @@
+"""Compiler from parsed instruction streams to flat bytecode for the PSIL VM.
+
+The instruction objects produced by parse.parse are convenient to build but
+slow to execute, every op has to be identified with an isinstance chain. This
+module flattens them into a list of integers (opcode, argument pairs) with the
+literal values moved into a constant pool, which the interpreter loop in
+psil.py can dispatch on directly."""
+
+import threading
+from collections import OrderedDict
+
+import data, optimize, parse
+
+## Opcodes. Every instruction is two slots wide: the opcode and its argument.
+## Ordered roughly by how often the interpreter loop sees them.
+PUSH = 0 # push consts[arg] on the stack
+CALL = 1 # execute the Reference consts[arg] without pushing it first
+NEW = 2 # start a new expression
+EXEC = 3 # pop a value off the stack and execute it
+END = 4 # end of the code body, return to the caller
+TCALL = 5 # CALL as the last instruction of a body
+TEXEC = 6 # EXEC as the last instruction of a body
+FOLD = 7 # push consts[arg].value and skip the instructions it replaced, if 
+         # consts[arg] (a parse.Fold) is still valid
+BACK = 8 # end of a body run inline (Interpreter.inline), back to the body 
+         # that ran it
+
+NAMES = ("PUSH", "CALL", "NEW", "EXEC", "END", "TCALL", "TEXEC", "FOLD", 
+         "BACK")
+
+class Bytecode:
+    """A compiled code body.
+
+    ops is the flat instruction list, consts holds the values referenced by
+    PUSH and CALL instructions. closure is the body compiled further to a 
+    Python function, once closures.compile did."""
+    def __init__(self, ops, consts):
+        self.ops = ops
+        self.consts = consts
+        self.closure = None
+
+    def __iter__(self):
+        """Yields (opcode, argument) pairs."""
+        for pc in range(0, len(self.ops), 2):
+            yield self.ops[pc], self.ops[pc+1]
+
+    def __str__(self):
+        return disassemble(self)
+
+def compile(instructions, optimized=False):
+    """Compile an iterable of parse.Instruction objects into Bytecode.
+    
+    A Push of a reference immediately followed by an Execute (the common
+    `(... name)` call) is fused into a single CALL, since the reference would
+    be popped again right away. A CALL or EXEC right before the END closes 
+    the last expression of the body, it is marked as a tail call (TCALL or 
+    TEXEC) so the interpreter can run the callee in the caller's frame.
+    
+    With optimized set the instructions go through optimize.fold first, and 
+    a Push of a code literal followed by an Execute becomes a CALL as well."""
+    if optimized:
+        instructions = optimize.fold(instructions)
+    ops = []
+    consts = []
+    emit(instructions, ops, consts, optimized)
+    if ops and ops[-2] == CALL:
+        ops[-2] = TCALL
+    elif ops and ops[-2] == EXEC:
+        ops[-2] = TEXEC
+    ops += (END, 0)
+    return Bytecode(ops, consts)
+    
+def inline(body):
+    """The Bytecode of a compiled body for running it inline, in the frame of
+    another body (Interpreter.inline). It ends in BACK, shares body's consts.
+    
+    Its last call keeps its TCALL or TEXEC. The frame is not the body's own
+    to hand over, the interpreter makes it a tail call only when the builtin
+    running the body was the tail call of its own body and runs nothing 
+    after it, like if in ((n 0 gt) {((n 1 sub) loop)} {...} if)."""
+    ops = list(body.ops)
+    ops[-2] = BACK
+    return Bytecode(ops, body.consts)
+    
+def emit(instructions, ops, consts, fuse=False):
+    """Append the compiled instructions to ops and consts.
+    
+    A Fold is compiled to a FOLD followed by the instructions it replaced.
+    fuse makes any Push followed by an Execute a CALL, not just references."""
+    pending = None # a Push that might still be fused with an Execute
+    for inst in instructions:
+        if pending is not None:
+            if isinstance(inst, parse.Execute) and \
+               (fuse or isinstance(pending.value, data.Reference)):
+                ops += (CALL, len(consts))
+                consts.append(pending.value)
+                pending = None
+                continue
+            ops += (PUSH, len(consts))
+            consts.append(pending.value)
+            pending = None
+        if isinstance(inst, parse.Push):
+            pending = inst
+        elif isinstance(inst, parse.NewExpression):
+            ops += (NEW, 0)
+        elif isinstance(inst, parse.Execute):
+            ops += (EXEC, 0)
+        elif isinstance(inst, parse.Fold):
+            ops += (FOLD, len(consts))
+            consts.append(inst)
+            start = len(ops)
+            emit(inst.instructions, ops, consts, fuse)
+            inst.skip = len(ops) - start
+        else:
+            raise TypeError("Cannot compile "+str(inst))
+    if pending is not None:
+        ops += (PUSH, len(consts))
+        consts.append(pending.value)
+        
+def disassemble(code):
+    """Human readable listing of a Bytecode object, one instruction a line."""
+    lines = []
+    for pc, (op, arg) in enumerate(code):
+        line = "{:4d} {:<5}".format(pc*2, NAMES[op])
+        if op in (PUSH, CALL, TCALL, FOLD):
+            line += " "+repr(code.consts[arg])
+        lines.append(line)
+    return "\n".join(lines)
+
+class Cache:
+    """Process wide cache of parsed and compiled code literal bodies.
+    
+    Keyed by the source text of the literal, so every copy of a literal (from 
+    dup, or from the same source being parsed again) shares one instruction 
+    list and one Bytecode object. Holds at most size bodies, evicting the least
+    recently used one when full. Bodies are compiled with the optimizer 
+    unless optimize is cleared.
+    
+    Safe to use from many threads: the entries are only touched under lock, 
+    parsing happens outside it. Two threads compiling the same body at once 
+    may both do it, they get equal Bytecode either way."""
+    def __init__(self, size=1024, optimize=True):
+        self.size = size
+        self.optimize = optimize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # source -> [instructions, Bytecode]
+        self.hits = 0
+        self.misses = 0
+        
+    def entry(self, string, source=None, start=0, end=None):
+        with self.lock:
+            entry = self.entries.get(string)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(string)
+                return entry
+            self.misses += 1
+        instructions = list(parse.parse(string if source is None else source,
+                                        start, end)) # other threads go on
+        with self.lock: # the first of several threads parsing string wins
+            entry = self.entries.setdefault(string, [instructions, None])
+            self.entries.move_to_end(string)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+        
+    def instructions(self, string, source=None, start=0, end=None):
+        """Return the parse.Instruction list for the body string.
+        
+        When string has to be parsed it is parsed as source[start:end], the 
+        span of a parse.Source it was copied from, so the offsets are those in
+        its file. Copies found elsewhere share the first one's body."""
+        return self.entry(string, source, start, end)[0]
+        
+    def compiled(self, string, source=None, start=0, end=None):
+        """Return the Bytecode for the body string."""
+        entry = self.entry(string, source, start, end)
+        if entry[1] is None:
+            entry[1] = compile(entry[0], self.optimize)
+        return entry[1]
+        
+    def resize(self, size):
+        """Change the bound, evicting bodies if the cache is now over it."""
+        if size < 0:
+            raise ValueError("A cache can not hold fewer than 0 bodies")
+        with self.lock:
+            self.size = size
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            
+    def set_optimize(self, optimize):
+        """Turn the optimizer on or off for the bodies compiled from now on.
+        
+        Cached bodies are compiled again, code literals that already have 
+        their Bytecode keep it."""
+        with self.lock:
+            if optimize != self.optimize:
+                self.optimize = optimize
+                for entry in self.entries.values():
+                    entry[1] = None
+            
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+        
+    def __str__(self):
+        return "code cache: {} of {} bodies, {} hits, {} misses".format(
+            len(self.entries), self.size, self.hits, self.misses)
+            
+cache = Cache()
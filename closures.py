@@ -0,0 +1,458 @@
+"""Compiler from bytecode to Python closures, a second way of running PSIL.
+
+The bytecode loop in psil.py pays for every instruction it runs: it fetches
+the opcode, finds it in a chain of comparisons and moves pc along. Here each
+compiled body (bytecode.Bytecode) is turned into the source of one Python
+function doing what its instructions do, written out one after the other with
+the constants as variables of the closure, which Python then compiles once.
+Runs of pushes become one extend of the stack and one update of the
+expression size, builtins are called right where the body calls them, and a
+builtin named by a name nothing ever bound (data.version 0) is called without
+looking the name up at all, and expressions of math builtins on numbers and
+names (effects.arithmetic) are worked out as one Python expression on the
+numbers, when the names of the builtins find them (Interpreter.finds, as for
+folds) and the other names find numbers.
+
+Calls of PSIL code still go through a loop, execute, so deep recursion and
+long tail call loops do not use up the Python stack. A body function returns
+to it at each call, saying where to go on from, and is called again there
+when the callee returns. To go on from the middle, the body is cut into
+blocks at the instructions following calls (and at the ends of what folds
+replace), each one run only if the bytecode offset to go on from is not past
+it:
+
+    def run(state, k):
+        if k <= 0:
+            ... up to and including the first call
+        if k <= 8:
+            ...
+
+psil.py --backend closures. Environments, builtins and the counting of
+instructions are the same as in the bytecode loop, the profiler and
+asynchronous streams are not supported."""
+
+import math, re
+
+import bytecode, data, effects, stdlib
+
+## Names the body functions use besides their constants
+_GLOBALS = {"versions": data.versions, "LLCode": data.LLCode,
+            "Code": data.Code, "Reference": data.Reference,
+            "Numeric": data.Numeric, "number": data.number}
+
+## Set up at the start of every run of a body, only those it needs
+_SETUP = (("stack", "stack = state.env.stack"),
+          ("items", "items = state.env.stack.items"),
+          ("arg_len", "arg_len = state.arg_len_stack"))
+
+HOT = 100 # runs of a body before it is compiled, most only ever run once
+
+class Closure:
+    """A body as a Python function, run(state, k) -> call or None.
+
+    run goes on from bytecode offset k until the body ends (giving None) or
+    calls PSIL code, giving (offset after the call, code, reference, tail) 
+    or, when a builtin asked for a call (Interpreter.call, inline), (offset 
+    after it, None, None, False). length is the number of instructions in 
+    the body.
+    
+    Compiling a body takes Python far longer than running it a few times, run
+    is interpret until the body has started HOT times, the function generated
+    for it from then on."""
+    __slots__ = ("run", "ops", "consts", "length", "runs", "source")
+
+    def __init__(self, body):
+        self.ops, self.consts = body.ops, body.consts
+        self.length = len(body.ops)//2
+        self.runs = 0
+        self.source = None
+        self.run = self.interpret
+        
+    def generate(self):
+        """Compile the body to a function, run from now on."""
+        self.source, names = generate(self.ops, self.consts)
+        namespace = dict(_GLOBALS)
+        exec(self.source, namespace)
+        self.run = namespace["make"](**names)
+        
+    def interpret(self, state, k):
+        """run, going through the instructions one by one as 
+        Interpreter.steps does."""
+        if not k:
+            self.runs += 1
+            if self.runs >= HOT:
+                self.generate()
+                return self.run(state, k)
+        PUSH, CALL, NEW, EXEC, TCALL, TEXEC, FOLD = bytecode.PUSH, \
+            bytecode.CALL, bytecode.NEW, bytecode.EXEC, bytecode.TCALL, \
+            bytecode.TEXEC, bytecode.FOLD
+        Reference, Code, LLCode = data.Reference, data.Code, data.LLCode
+        ops, consts = self.ops, self.consts
+        stack, arg_len = state.env.stack, state.arg_len_stack
+        pc = k
+        while True:
+            op = ops[pc]
+            if op == PUSH:
+                stack.append(consts[ops[pc+1]])
+                arg_len[-1] += 1
+                pc += 2
+                continue
+            elif op == NEW:
+                arg_len.append(0)
+                pc += 2
+                continue
+            elif op == CALL or op == TCALL:
+                value = consts[ops[pc+1]]
+            elif op == EXEC or op == TEXEC:
+                value = stack.pop()
+                arg_len[-1] -= 1
+            elif op == FOLD:
+                fold = consts[ops[pc+1]]
+                if fold.valid(state):
+                    stack.append(fold.value)
+                    if arg_len:
+                        arg_len[-1] += 1
+                    pc += 2 + fold.skip
+                    state.ops -= fold.skip//2
+                else:
+                    pc += 2
+                continue
+            else: # END or BACK
+                return None
+            pc += 2
+            if isinstance(value, Reference):
+                code = state.search(value)
+            else:
+                code, value = value, None
+            if isinstance(code, LLCode):
+                state.call_builtin(code)
+                if state.pending is not None:
+                    return (pc, None, None, False)
+            elif isinstance(code, Code):
+                return (pc, code, value, op >= TCALL)
+            else:
+                raise TypeError("Cannot execute non-code "+repr(code))
+
+def compile(body):
+    """The Closure of a Bytecode object, made on first use and kept on it."""
+    closure = body.closure
+    if closure is None:
+        closure = body.closure = Closure(body) # threads racing make equal ones
+    return closure
+
+def labels(ops, consts, starts=()):
+    """The bytecode offsets the blocks of a body start at: the start, what 
+    follows each call, the start and end of what each fold replaced, and 
+    starts."""
+    found = {0, *starts}
+    for pc in range(0, len(ops), 2):
+        op = ops[pc]
+        if op in (bytecode.CALL, bytecode.EXEC, bytecode.TCALL,
+                  bytecode.TEXEC):
+            found.add(pc+2)
+        elif op == bytecode.FOLD:
+            found.add(pc+2)
+            found.add(pc+2+consts[ops[pc+1]].skip)
+    return found
+
+def generate(ops, consts):
+    """Python source defining make(constants...) -> run for the body with
+    ops and consts, and the names to call make with."""
+    trees = effects.arithmetic(ops, consts)
+    writer = Writer(consts, labels(ops, consts, trees), trees)
+    for pc in range(0, len(ops), 2):
+        writer.emit(pc, ops[pc], ops[pc+1])
+    writer.flush()
+    lines = ["def make("+", ".join(writer.names)+"):",
+             "    def run(state, k):"]
+    text = "\n".join(writer.lines)
+    for name, line in _SETUP:
+        if re.search(r"\b"+name+r"\b", text):
+            lines.append("        "+line)
+    lines += writer.lines
+    lines += ["        return None", "    return run"]
+    return "\n".join(lines)+"\n", writer.names
+
+class Writer:
+    """Writes out the instructions of one body as Python statements.
+
+    Pushes and the growth of the expression they count toward are held back
+    and written as one statement each, before anything that could look at
+    the stack. Expressions of Math builtins (effects.arithmetic) start blocks
+    of their own, with their value worked out in one go before them."""
+    def __init__(self, consts, blocks, trees):
+        self.consts = consts
+        self.blocks = blocks # bytecode offsets blocks start at
+        self.trees = trees # bytecode offset -> (tree, offset after it)
+        self.names = {} # parameter of make -> its value
+        self.lines = []
+        self.pushes = [] # parameters pushed since the last flush
+        self.count = 0 # values added to the expression since then
+
+    def name(self, value, prefix="c"):
+        """The parameter of make holding value."""
+        name = prefix+str(len(self.names))
+        self.names[name] = value
+        return name
+
+    def line(self, text, indent=0):
+        self.lines.append(" "*(12+4*indent)+text)
+
+    def flush(self):
+        """Write out the pushes held back."""
+        if self.count:
+            opened = " "*12+"arg_len.append(0)"
+            if self.lines and self.lines[-1] == opened:
+                self.lines[-1] = " "*12+"arg_len.append({})".format(self.count)
+            else:
+                self.line("arg_len[-1] += {}".format(self.count))
+            self.count = 0
+        if len(self.pushes) == 1:
+            self.line("items.append({})".format(self.pushes[0]))
+        elif self.pushes:
+            self.line("items.extend(({},))".format(", ".join(self.pushes)))
+        self.pushes = []
+
+    def emit(self, pc, op, arg):
+        if pc in self.blocks:
+            self.flush()
+            if self.lines and self.lines[-1].startswith("        if k"):
+                self.line("pass") # the block before is empty
+            self.lines.append("        if k <= {}:".format(pc))
+            if pc in self.trees: # its instructions, if it could not be done
+                self.arithmetic(*self.trees[pc])
+                self.lines.append("        if k <= {}:".format(pc))
+        if op == bytecode.PUSH:
+            self.pushes.append(self.name(self.consts[arg]))
+            self.count += 1
+            return
+        self.flush()
+        if op == bytecode.NEW:
+            self.line("arg_len.append(0)")
+        elif op == bytecode.FOLD:
+            fold = self.consts[arg]
+            self.line("if {}.valid(state):".format(self.name(fold, "f")))
+            self.line("items.append({})".format(self.name(fold.value)), 1)
+            self.line("if arg_len:", 1) # none at the top level of a program
+            self.line("arg_len[-1] += 1", 2)
+            if fold.skip:
+                self.line("state.ops -= {}".format(fold.skip//2), 1)
+            self.line("k = {}".format(pc+2+fold.skip), 1)
+        elif op in (bytecode.CALL, bytecode.TCALL):
+            self.call(self.consts[arg], pc+2, op == bytecode.TCALL)
+        elif op in (bytecode.EXEC, bytecode.TEXEC):
+            self.line("code = stack.pop()")
+            self.line("arg_len[-1] -= 1")
+            self.line("value = None")
+            self.line("if isinstance(code, Reference):")
+            self.line("value = code", 1)
+            self.line("code = state.search(code)", 1)
+            self.dispatch("value", pc+2, op == bytecode.TEXEC)
+        else: # END or BACK
+            self.line("return None")
+
+    def call(self, value, after, tail):
+        """Call the constant value, a Reference or a code literal."""
+        if not isinstance(value, data.Reference):
+            if isinstance(value, data.Code) and \
+               not isinstance(value, data.LLCode):
+                self.line("return ({}, {}, None, {})".format(
+                    after, self.name(value), tail))
+                return
+            self.line("code = "+self.name(value))
+            self.dispatch("None", after, tail)
+            return
+        reference = self.name(value)
+        found = stdlib.builtins.get(value.first)
+        if len(value.names) == 1 and isinstance(found, data.LLCode):
+            # the builtin as long as nothing ever bound the name
+            self.line("if {!r} not in versions:".format(value.first))
+            builtin = self.name(found, "b")
+            if found.pure: # never asks for a call, Interpreter.call_builtin
+                self.line("size = len(items)", 1)
+                self.line(builtin+"(state)", 1)
+                self.line("count = arg_len.pop() + len(items) - size", 1)
+                self.line("if arg_len:", 1)
+                self.line("arg_len[-1] += count", 2)
+            else:
+                self.line("state.call_builtin({})".format(builtin), 1)
+                self.returns(after, 1)
+            self.line("else:")
+            self.line("code = state.search({})".format(reference), 1)
+            self.dispatch(reference, after, tail, 1)
+            return
+        self.line("code = state.search({})".format(reference))
+        self.dispatch(reference, after, tail)
+
+    def arithmetic(self, tree, after):
+        """Push the value of tree and go on from after, as long as the names
+        of its builtins find them (Interpreter.finds) and the names in it 
+        find numbers.
+
+        Names are looked up in the order the builtins would, one failing to
+        be found leaves it to the instructions, to fail as they do."""
+        names, checks, found = [], [], []
+        text = self.operand(tree, names, checks, found)
+        self.line("if {}:".format(" and ".join(
+            ["({!r} not in versions or state.finds({}, {}))".format(
+                name, self.name(data.Reference(name), "r"), 
+                self.name(code, "b")) for name, code in names]+checks)))
+        indent = 1
+        if found:
+            self.line("try:", 1)
+            for variable, reference in found:
+                self.line("{} = state.search({})".format(variable, reference),
+                          2)
+            self.line("except (NameError, AttributeError):", 1)
+            self.line("{} = None".format(found[0][0]), 2)
+            self.line("if {}:".format(" and ".join(
+                "isinstance({}, Numeric)".format(variable)
+                for variable, _ in found)), 1)
+            indent = 2
+        self.line("items.append(number({}))".format(text), indent)
+        self.line("if arg_len:", indent)
+        self.line("arg_len[-1] += 1", indent+1)
+        self.line("k = {}".format(after), indent)
+
+    def operand(self, value, names, checks, found):
+        """Python expression for the number value is or stands for, a tree
+        or one of its operands. Adds (name, builtin) of the builtins it uses
+        to names, checks of the folds in it to checks, and (variable, 
+        reference) for the names to look up to found, innermost expressions
+        first as they run."""
+        if isinstance(value, tuple):
+            name, code, left, right = value
+            if (name, code) not in names:
+                names.append((name, code))
+            texts = [self.operand(part, names, checks, found)
+                     if isinstance(part, tuple) else None
+                     for part in (left, right)]
+            texts = [self.operand(part, names, checks, found)
+                     if text is None else text
+                     for part, text in zip((left, right), texts)]
+            return "({} {} {})".format(texts[0], 
+                                       effects.OPERATORS[code.function], 
+                                       texts[1])
+        if isinstance(value, data.Reference):
+            variable = "v"+str(len(found))
+            found.append((variable, self.name(value)))
+            return variable+".val"
+        if not isinstance(value, data.Numeric): # a parse.Fold
+            checks.append(self.name(value, "f")+".valid(state)")
+            value = value.value
+        if type(value.val) is int or math.isfinite(value.val):
+            return "({!r})".format(value.val) if value.val < 0 \
+                   else repr(value.val)
+        return self.name(value)+".val"
+
+    def returns(self, after, indent=0):
+        """Go back to execute if the builtin just run asked for a call."""
+        self.line("if state.pending is not None:", indent)
+        self.line("return ({}, None, None, False)".format(after), indent+1)
+
+    def dispatch(self, reference, after, tail, indent=0):
+        """Run the value of code: builtins here, code literals by execute."""
+        self.line("if isinstance(code, LLCode):", indent)
+        self.line("state.call_builtin(code)", indent+1)
+        self.returns(after, indent+1)
+        self.line("elif isinstance(code, Code):", indent)
+        self.line("return ({}, code, {}, {})".format(after, reference, tail),
+                  indent+1)
+        self.line("else:", indent)
+        self.line('raise TypeError("Cannot execute non-code "+repr(code))',
+                  indent+1)
+
+def execute(state, program):
+    """Run a Bytecode object to completion in the current environment of
+    state, a psil.Interpreter, compiling the bodies it runs to closures.
+
+    The loop over calls of Interpreter.steps, with each body run by its
+    Closure instead of instruction by instruction. Each running body is
+    (closure, offset to go on from, carry, levels, then, inline), carry,
+    levels and then as in steps, inline set for bodies run by
+    Interpreter.inline."""
+    arg_len = state.arg_len_stack
+    frames = []
+    body, k, carry, levels, inline = compile(program), 0, 0, 1, False
+    try:
+        while True:
+            call = body.run(state, k)
+            if call is None: # the body ended
+                state.ops += body.length
+                if inline: # carry is the count when it started
+                    then = frames[-1][4]
+                    code = None if then is None else then(state,
+                                                          arg_len[-1] - carry)
+                    if code is None: # the builtin's expression is done
+                        body, k, carry, levels, then, inline = frames.pop()
+                        count = arg_len.pop()
+                        if arg_len:
+                            arg_len[-1] += count
+                        continue
+                    inlined = code.inlined()
+                    body = inlined.closure or compile(inlined)
+                    k, carry = 0, arg_len[-1]
+                    continue
+                if not frames:
+                    return
+                size = state.env.stack.size
+                left = size + carry
+                if arg_len:
+                    arg_len[-1] += left + size*(levels-1)
+                state.pop_env()
+                body, k, carry, levels, then, inline = frames.pop()
+                if then is not None:
+                    then(state, left)
+                continue
+            k, code, value, tail = call
+            if code is None: # a builtin asked for a call
+                code, value, then, into = state.pending
+                state.pending = None
+                if into: # in this frame, the expression stays open
+                    frames.append((body, k, carry, levels, then, inline))
+                    inlined = code.inlined()
+                    body = inlined.closure or compile(inlined)
+                    k, carry, inline = 0, arg_len[-1], True
+                    continue
+                state.append_env(value, code)
+            else:
+                then = None
+                # as in steps, frames[level:] are the bodies run inline
+                # that this call ends and their callers
+                level, running = len(frames), inline
+                while running and level > 1:
+                    caller, after, _, _, next_body, running = frames[level-1]
+                    if next_body is not None or \
+                       caller.ops[after-2] < bytecode.TCALL:
+                        break
+                    level -= 1
+                if tail and not running and level:
+                    left = state.tail_env(value)
+                    if left is not None: # running in this frame now
+                        if level < len(frames): # end the bodies run inline
+                            for frame in reversed(frames[level+1:]):
+                                state.ops += k//2
+                                k = frame[1]
+                            state.ops += k//2
+                            for _ in range(len(frames) - level):
+                                count = arg_len.pop() # their expressions
+                                if arg_len:
+                                    arg_len[-1] += count
+                            k, carry = frames[level][1], frames[level][2]
+                            del frames[level:]
+                            inline = False
+                        if arg_len: # values left below count at every level
+                            arg_len[-1] += left*(levels-1)
+                        carry, levels = carry + left, levels + 1
+                        state.ops += k//2
+                        compiled = code.compiled()
+                        body, k = compiled.closure or compile(compiled), 0
+                        continue
+                state.append_env(value)
+            frames.append((body, k, carry, levels, then, inline))
+            compiled = code.compiled()
+            body = compiled.closure or compile(compiled)
+            k, carry, levels, inline = 0, 0, 1, False
+    except BaseException: # count what the unfinished bodies ran, roughly
+        state.ops += (k + sum(frame[1] for frame in frames))//2
+        raise
@@ -4,30 +4,72 @@
 Author: Timothy Hewitt
 Date: 2015-03-19"""
 
-import parse
+import operator, sys
+from array import array
+from itertools import count, repeat
+from types import MappingProxyType
+
+try: # vectors use numpy arrays when it is there, the array module otherwise
+    import numpy
+except ImportError:
+    numpy = None
+
+import parse, bytecode
+
+## Binding versions, one per name. Every bind or unbind of a name, in any 
+## namespace, gives it a new version. Name lookups cached while the versions 
+## of the names involved stayed the same are still correct. Versions are drawn
+## from one process wide count, not incremented per name, so interpreters 
+## binding the same name in different threads never end up writing the same
+## new version (next on an itertools.count is atomic).
+versions = {}
+_stamps = count(1)
+
+def version(name):
+    """Current binding version of name."""
+    return versions.get(name, 0)
+    
+## Read only stand in for the dict of a namespace nothing was bound into yet.
+## Literals start out with it, so plain values do not carry a dict each.
+EMPTY = MappingProxyType({})
 
 class Namespace:
-    """Represents the type of a namespace, the catchall type."""
+    """Represents the type of a namespace, the catchall type.
+    
+    Everything is slotted: a value costs its fields and nothing else. Names 
+    are kept in dict, which is the shared EMPTY mapping until something is 
+    bound into the namespace."""
+    __slots__ = ("dict", "parent")
+    stack = None # only execution environments (Frame) have a stack
+    lookups = None
+    escaped = False
+    
     def __init__(self, stack=None, parent=None, **kwdarg):
         if isinstance(stack, Namespace): # copy intended:
             self.dict = dict(stack.dict)
             self.parent = None # copying search path could be dangerous
-            self.stack = None # stack references screw up name searching.
+            # stack references screw up name searching, copies have none.
         else:
-            self.dict = kwdarg
+            self.dict = kwdarg if kwdarg else EMPTY
             self.parent = parent # "reversed" linked list of execution namespaces
-            self.stack = stack
+            if stack is not None:
+                raise TypeError("Execution environments are data.Frame objects")
     
     def bind(self, ns, name):
         if not isinstance(ns, Namespace):
             raise TypeError(str(ns) +" is not a namespace.")
         else:
+            if self.dict is EMPTY:
+                self.dict = {}
             self.dict[name]=ns
-            ns.parent = None # references do not point back, solves aliasing
+            versions[name] = next(_stamps)
+            if ns.parent is not None:
+                ns.parent = None # references do not point back, solves aliasing
             
     def unbind(self, name):
         if self.validate(name):
             del self.dict[name]
+            versions[name] = next(_stamps)
         # fail quiet on deletion that doesn't exist
         
     def get(self, name):
@@ -39,16 +81,44 @@ class Namespace:
     def validate(self, name):
         """Return whether id is a valid identifier for this namespace."""
         return name in self.dict
+        
+    def own_dict(self):
+        """Return the dict of this namespace, replacing EMPTY by a real one."""
+        if self.dict is EMPTY:
+            self.dict = {}
+        return self.dict
             
     def __str__(self):
         return "this: "+repr(self)+"\n"+\
                "stack: "+str(self.stack)+"\n"+\
-               "Children: "+str(self.dict)+"\n"+\
+               "Children: "+str(dict(self.dict))+"\n"+\
                "parent: \n\\\n"+str(self.parent)+"\n/\n"
                
+class Frame(Namespace):
+    """An execution environment: a namespace with a view of the data stack.
+    
+    lookups caches where names looked up from this environment were found, as
+    name -> (namespace, version). escaped is set when get hands the 
+    environment out as a value."""
+    __slots__ = ("stack", "lookups", "escaped")
+    
+    def __init__(self, stack, parent=None, **kwdarg):
+        self.dict = kwdarg
+        self.parent = parent
+        self.stack = stack
+        self.lookups = {}
+        self.escaped = False
+               
 class Reference(Namespace):
-    """Pointer equivalent in PSIL"""
+    """Pointer equivalent in PSIL
+    
+    A Reference in compiled code is a lookup site, cache holds the last 
+    (environment, versions, result) it was resolved to."""
+    __slots__ = ("string", "names", "first", "last", "cache")
+    
     def __init__(self, seed):
+        super().__init__()
+        self.cache = None
         if isinstance(seed, str):
             self.string = seed
         elif isinstance(seed, Reference):
@@ -69,7 +139,7 @@ class Reference(Namespace):
         """Returns a copy of the reference without this reference's last name.
         
         returns empty Reference if this Reference has a single name."""
-        return Reference(":".join(self.names[:-2]))
+        return Reference(":".join(self.names[:-1]))
         
     def __str__(self):
         return self.string
@@ -77,27 +147,151 @@ class Reference(Namespace):
     def __repr__(self):
         return "PSIL Reference: "+self.string
 
+class Scope(Namespace):
+    """A namespace as it appears on the search path of a running call.
+    
+    Shares the dictionary of the namespace it stands in for, so bindings made
+    through either are seen by both, but carries its own parent link. The
+    namespace being called into is never modified, so the same code literal 
+    can be on the search path of several calls at once (recursion)."""
+    __slots__ = ("target",)
+    
+    def __init__(self, target, parent):
+        self.dict = target.own_dict()
+        self.parent = parent
+        self.target = target
+
 class Literal(Namespace):
-    """Superclass for all the literal types in PSIL."""
+    """Superclass for all the literal types in PSIL.
+    
+    Literals are values, copied on write. Their payload (number, text, code 
+    body) never changes, so one instance can stand for any number of copies:
+    a literal in compiled code is pushed as is every time, dup pushes the 
+    same instance again. Only binding a name into a literal changes it, and 
+    that only happens to a literal with a dict of its own (a real dict, not 
+    EMPTY or a read only view). Those are made by copy, when something is 
+    bound into a literal through a name (Interpreter.writable), and stay 
+    reachable only through that name until freeze makes them shared again."""
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__()
+        
+    def bind(self, ns, name):
+        if type(self.dict) is not dict:
+            raise TypeError("Cannot bind "+name+" into shared value "+
+                            repr(self)+", bind into a copy")
+        super().bind(ns, name)
+        
+    def unbind(self, name):
+        if type(self.dict) is not dict:
+            raise TypeError("Cannot unbind "+name+" from shared value "+
+                            repr(self)+", unbind from a copy")
+        super().unbind(name)
+        
+    def own_dict(self):
+        """The dict as it is, literals are never changed through a Scope."""
+        return self.dict
+        
+    def copy(self):
+        """A copy sharing the payload, with a dict of its own to bind into."""
+        new = type(self)(self)
+        new.dict = dict(self.dict)
+        return new
+        
+def frozen(value):
+    """Whether value is a literal that may be shared, which has to be copied
+    before anything is bound into it."""
+    return isinstance(value, Literal) and type(value.dict) is not dict
+    
+def freeze(value):
+    """Mark value as shared, for when it is about to be reachable from a 
+    second place (get, dup). Returns value."""
+    if type(value.dict) is dict and isinstance(value, Literal):
+        value.dict = MappingProxyType(value.dict)
+    return value
+    
+def library(names, parent=None):
+    """A read only namespace of names, shared by any number of interpreters.
+    
+    Used as the parent of their top level environments (stdlib.namespace, 
+    psil.library). The literals in it, and everything bound into them, are 
+    frozen, so running code in several interpreters at once, in as many 
+    threads, never changes anything in it: binding into one of its values 
+    makes a copy in the interpreter doing it (Interpreter.writable)."""
+    ns = Namespace(None, parent)
+    ns.dict = MappingProxyType(dict(names))
+    seen = set()
+    values = list(names.values())
+    while values:
+        value = values.pop()
+        if id(value) not in seen:
+            seen.add(id(value))
+            if isinstance(value, Literal):
+                values.extend(freeze(value).dict.values())
+    return ns
     
 class Code(Literal):
-    """Type for a code literal."""
+    """Type for a code literal.
+    
+    A span of the parse.Source it was written in, its body is copied out of 
+    it (string) only to be parsed when first run."""
+    __slots__ = ("source", "span", "op_list", "bytecode", "inline_bytecode")
+    
     def __init__(self, token=None):
         if isinstance(token, parse.Token):
-            self.string = token.string
+            self.source = token.source
+            self.span = (token.start, token.end) # offsets in the source
         elif isinstance(token, Code):
-            self.string = token.string[:]
+            self.source = token.source
+            self.span = token.span
+            if hasattr(token, "op_list"): # copies share the parsed body
+                self.op_list = token.op_list
+            if hasattr(token, "bytecode"):
+                self.bytecode = token.bytecode
+            if hasattr(token, "inline_bytecode"):
+                self.inline_bytecode = token.inline_bytecode
         else:
-            self.string = "<Builtin>"
+            self.source = None
+            self.span = (None, None)
         super().__init__()
         
+    @property
+    def string(self):
+        """The body, the source between the braces."""
+        if self.source is None:
+            return "<Builtin>"
+        return self.source.text[self.span[0]+1:self.span[1]-1]
+        
     def __iter__(self):
         if not hasattr(self, "op_list"):
-            self.op_list = [op for op in parse.parse(iter(self.string))]
+            self.op_list = bytecode.cache.instructions(self.string, 
+                                                       *self.body())
         return iter(self.op_list)
         
+    def compiled(self):
+        """Return the Bytecode for this literal, compiling it on first use.
+        
+        Literals with the same source share one compiled body through 
+        bytecode.cache, however many copies of them are made."""
+        if not hasattr(self, "bytecode"):
+            self.bytecode = bytecode.cache.compiled(self.string, 
+                                                    *self.body())
+        return self.bytecode
+        
+    def inlined(self):
+        """Return the Bytecode for running this literal inline, in the frame
+        of the body running it (see Interpreter.inline)."""
+        if not hasattr(self, "inline_bytecode"):
+            self.inline_bytecode = bytecode.inline(self.compiled())
+        return self.inline_bytecode
+        
+    def body(self):
+        """The source and offsets of the body, (parse.Source, start, end)."""
+        if self.source is None:
+            return (None, 0, None)
+        return (self.source, self.span[0]+1, self.span[1]-1)
+        
     def __repr__(self):
         return "PSIL Code Literal: "+str(self.string)
             
@@ -105,20 +299,39 @@ class LLCode(Code):
     """Superclass for any code not implemented in PSIL
     
     This code is invoked by calling the LLCode object during the Execute 
-    instruction."""
+    instruction. Builtins whose result depends on nothing but their arguments
+    set pure, the optimizer then works out their calls on literals ahead of
+    time through fold. Builtins doing I/O on the interpreter's streams set
+    blocking, the interpreter then lets them wait for asynchronous streams 
+    (Interpreter.call_io). Builtins always taking the same number of values 
+    off the stack and leaving the same number on it say so in effect, as 
+    (taken, left), for effects.check."""
+    pure = False
+    blocking = False
+    effect = None
+    
     def __call__(self, state):
         """Hook for subclasses."""
         pass 
+        
+    def fold(self, values):
+        """What a pure builtin leaves run on values, or None if that can not
+        be worked out ahead of time."""
+        return None
     
 class String(Literal):
     """Type for a string literal.
     
     I may work on unicode support, but it's not required for a proof of 
     concept."""
+    __slots__ = ("string",)
+    
     def __init__(self, token):
         """Creates the actual data object from the token representing it."""
         if isinstance(token, String):
             self.string = str(token.string)
+        elif isinstance(token, str): # made by a builtin
+            self.string = token
         else:
             self.string = token.string
         super().__init__()
@@ -129,17 +342,125 @@ class String(Literal):
     def __str__(self):
         return self.string
         
+class Sequence(Literal):
+    """An ordered run of values, made by builtins reading many at once."""
+    __slots__ = ("items",)
+    
+    def __init__(self, items=()):
+        if isinstance(items, Sequence):
+            items = items.items
+        self.items = list(items)
+        super().__init__()
+        
+    def __len__(self):
+        return len(self.items)
+        
+    def __repr__(self):
+        return "PSIL Sequence: "+str(self)
+        
+    def __str__(self):
+        return "["+", ".join(str(item) for item in self.items)+"]"
+        
+class Handle(Literal):
+    """An open stream, as PSIL code sees it.
+    
+    stream is a streams.Input or streams.Output, or None for the standard 
+    streams of the interpreter running the code, which are then found by name
+    (stdin, stdout, stderr). Copies share the stream."""
+    __slots__ = ("stream", "name")
+    
+    def __init__(self, stream=None, name=None):
+        if isinstance(stream, Handle):
+            self.stream = stream.stream
+            self.name = stream.name
+        else:
+            self.stream = stream
+            self.name = name if name is not None else stream.name
+        super().__init__()
+        
+    def __repr__(self):
+        return "PSIL Handle: "+str(self.name)
+        
+    def __str__(self):
+        return "<"+str(self.name)+">"
+        
 class Numeric(Literal):
-    """Type superclass for numbers in PSIL."""
+    """Type superclass for numbers in PSIL.
+    
+    Arithmetic works on the Python numbers directly and promotes to Float 
+    whenever a Float is involved, the same way Python does. Results are made 
+    with number(), so common small integers are not allocated again."""
+    __slots__ = ("val",)
+    
     def __str__(self):
         return str(self.val)
+        
+    def __add__(self, other):
+        if not isinstance(other, Numeric):
+            if isinstance(other, Vector): # it does each of its items
+                return NotImplemented
+            raise TypeError("Cannot add non-Numeric "+str(other))
+        return number(self.val+other.val)
+        
+    def __sub__(self, other):
+        if not isinstance(other, Numeric):
+            if isinstance(other, Vector): # it does each of its items
+                return NotImplemented
+            raise TypeError("Cannot subtract non-Numeric "+str(other))
+        return number(self.val-other.val)
+        
+    def __mul__(self, other):
+        if not isinstance(other, Numeric):
+            if isinstance(other, Vector): # it does each of its items
+                return NotImplemented
+            raise TypeError("Cannot multiply non-Numeric "+str(other))
+        return number(self.val*other.val)
+        
+    def __truediv__(self, other):
+        """Division is always true division, (3 5 div) is 0.6"""
+        if not isinstance(other, Numeric):
+            if isinstance(other, Vector): # it does each of its items
+                return NotImplemented
+            raise TypeError("Cannot divide non-Numeric "+str(other))
+        return number(self.val/other.val)
+        
+    def __mod__(self, other):
+        if not isinstance(other, Numeric):
+            if isinstance(other, Vector): # it does each of its items
+                return NotImplemented
+            raise TypeError("Cannot take modulus of non-Numeric "+str(other))
+        return number(self.val%other.val)
+        
+    def __lt__(self, other):
+        if not isinstance(other, Numeric):
+            raise TypeError("Cannot compare non-Numeric "+str(other))
+        return self.val < other.val
+        
+    def __gt__(self, other):
+        if not isinstance(other, Numeric):
+            raise TypeError("Cannot compare non-Numeric "+str(other))
+        return self.val > other.val
+        
+    def __le__(self, other):
+        if not isinstance(other, Numeric):
+            raise TypeError("Cannot compare non-Numeric "+str(other))
+        return self.val <= other.val
+        
+    def __ge__(self, other):
+        if not isinstance(other, Numeric):
+            raise TypeError("Cannot compare non-Numeric "+str(other))
+        return self.val >= other.val
     
 class Integer(Numeric):
     """Type for integer data in PSIL."""
+    __slots__ = ()
+    
     def __init__(self, seed):
-        if isinstance(seed, str):
+        if isinstance(seed, int):
+            self.val = seed
+        elif isinstance(seed, str):
             self.val = int(seed)
-        elif isinstance(seed, Integer):
+        elif isinstance(seed, Numeric):
             self.val = int(seed.val)
         else:
             self.val = int(seed.string)
@@ -147,83 +468,258 @@ class Integer(Numeric):
         
     def __repr__(self):
         return "PSIL Integer: "+str(self.val)
-        
-    def __mul__(self, other):
-        if not isinstance(other, Numeric):
-            raise TypeError("Cannot multiply non-Numeric "+str(other))
-        if isinstance(other, Integer):
-            return Integer(parse.Token(str(self.val*other.val)))
-        elif isinstance(other, Float):
-            return Float(parse.Token(str(self.val*other.val)))
-        else:
-            raise TypeError("Unrecognized Numeric "+str(other))
-            
-    def __sub__(self, other):
-        if not isinstance(other, Numeric):
-            raise TypeError("Cannot subtract non-Numeric "+str(other))
-        if isinstance(other, Integer):
-            return Integer(parse.Token(str(self.val-other.val)))
-        elif isinstance(other, Float):
-            return Float(parse.Token(str(self.val-other.val)))
-        else:
-            raise TypeError("Unrecognized Numeric "+str(other))
     
 class Float(Numeric):
-    """Type for integer data in PSIL."""
+    """Type for floating point data in PSIL."""
+    __slots__ = ()
+    
     def __init__(self, seed):
-        if isinstance(seed, str):
+        if isinstance(seed, (float, int)):
             self.val = float(seed)
-        elif isinstance(seed, Float):
+        elif isinstance(seed, str):
+            self.val = float(seed)
+        elif isinstance(seed, Numeric):
             self.val = float(seed.val)
         else:
             self.val = float(seed.string)
         super().__init__()
         
-    def __str__(self):
+    def __repr__(self):
         return "PSIL Float: "+str(self.val)
+        
+SMALL_MIN, SMALL_MAX = -128, 1024 # range of the shared Integer instances
+
+_small_ints = [Integer(val) for val in range(SMALL_MIN, SMALL_MAX)]
+
+def number(val):
+    """Make a PSIL number from a Python int or float.
+    
+    Integers from SMALL_MIN up to SMALL_MAX come from a table of shared 
+    instances, which like any literal are copied before a name is bound into
+    them."""
+    if type(val) is int:
+        if SMALL_MIN <= val < SMALL_MAX:
+            return _small_ints[val-SMALL_MIN]
+        return Integer(val)
+    elif type(val) is bool:
+        return _small_ints[val-SMALL_MIN]
+    return Float(val)
+    
+def boolean(flag):
+    """The PSIL value for a Python truth value, 1 or 0."""
+    return _small_ints[1-SMALL_MIN] if flag else _small_ints[-SMALL_MIN]
+    
+class Vector(Literal):
+    """A run of numbers kept unboxed, one machine word each.
     
+    items is a numpy array when numpy is installed, an array.array otherwise,
+    of 64 bit integers ("q") or doubles ("d"). Arithmetic with another Vector
+    of the same length or a number works on all the items at once, without 
+    going through the interpreter for each. Vectors are never changed, every
+    operation makes a new one, so copies and literals can share their items."""
+    __slots__ = ("items",)
+    
+    def __init__(self, seed=()):
+        if isinstance(seed, Vector):
+            self.items = seed.items
+        elif isinstance(seed, parse.Token):
+            self.items = _vector(int(s) if "." not in s else float(s)
+                                 for s in seed.string.split())
+        else:
+            self.items = _vector(seed)
+        super().__init__()
+        
+    def __len__(self):
+        return len(self.items)
+        
+    def __repr__(self):
+        return "PSIL Vector: "+str(self)
+        
+    def __str__(self):
+        return "["+" ".join(str(val) for val in self.items.tolist())+"]"
+        
+    def floating(self):
+        if numpy is not None:
+            return self.items.dtype.kind == "f"
+        return self.items.typecode == "d"
+        
+    def item(self, index):
+        """The number at index, negative ones count from the end."""
+        return number(self.items[index].item() if numpy is not None else 
+                      self.items[index])
+        
+    def combine(self, function, other, reverse=False):
+        """New Vector of function applied to each item and the matching one of
+        other, a Vector or a number (then used for every item).
+        
+        function is a Python operator, reverse swaps its arguments."""
+        if isinstance(other, Vector):
+            if len(other.items) != len(self.items):
+                raise ValueError("Vectors of different lengths: {} and {}"
+                                 .format(len(self.items), len(other.items)))
+            values = other.items
+        elif isinstance(other, Numeric):
+            values = other.val
+        else:
+            raise TypeError("Cannot combine Vector with non-Numeric "+
+                            str(other))
+        left, right = (values, self.items) if reverse else (self.items, values)
+        if numpy is not None:
+            if function not in (operator.truediv, operator.mod):
+                return Vector(function(left, right))
+            try: # numpy only warns, Python raises
+                with numpy.errstate(divide="raise", invalid="raise"):
+                    return Vector(function(left, right))
+            except FloatingPointError:
+                raise ZeroDivisionError("Vector division by zero")
+        if not isinstance(other, Vector):
+            left = repeat(left) if reverse else left
+            right = right if reverse else repeat(right)
+        return Vector(list(map(function, left, right)))
+        
+    def __add__(self, other):
+        return self.combine(operator.add, other)
+        
+    def __radd__(self, other):
+        return self.combine(operator.add, other, True)
+        
+    def __sub__(self, other):
+        return self.combine(operator.sub, other)
+        
+    def __rsub__(self, other):
+        return self.combine(operator.sub, other, True)
+        
+    def __mul__(self, other):
+        return self.combine(operator.mul, other)
+        
+    def __rmul__(self, other):
+        return self.combine(operator.mul, other, True)
+        
+    def __truediv__(self, other):
+        return self.combine(operator.truediv, other)
+        
+    def __rtruediv__(self, other):
+        return self.combine(operator.truediv, other, True)
+        
+    def __mod__(self, other):
+        return self.combine(operator.mod, other)
+        
+    def __rmod__(self, other):
+        return self.combine(operator.mod, other, True)
+        
+    def sum(self):
+        if numpy is not None:
+            return number(self.items.sum().item())
+        return number(sum(self.items))
+        
+    def min(self):
+        if not len(self.items):
+            raise ValueError("min of an empty Vector")
+        if numpy is not None:
+            return number(self.items.min().item())
+        return number(min(self.items))
+        
+    def max(self):
+        if not len(self.items):
+            raise ValueError("max of an empty Vector")
+        if numpy is not None:
+            return number(self.items.max().item())
+        return number(max(self.items))
+        
+    def dot(self, other):
+        """Sum of the products of the items of self and other."""
+        if not isinstance(other, Vector):
+            raise TypeError("Cannot take dot product with non-Vector "+
+                            str(other))
+        if len(other.items) != len(self.items):
+            raise ValueError("Vectors of different lengths: {} and {}"
+                             .format(len(self.items), len(other.items)))
+        if numpy is not None:
+            return number(numpy.dot(self.items, other.items).item())
+        return number(sum(map(operator.mul, self.items, other.items)))
+        
+    def slice(self, start, end):
+        """New Vector of the items from start up to end, as Python slices."""
+        if numpy is not None:
+            return Vector(self.items[start:end].copy())
+        return Vector(self.items[start:end])
+        
+def _vector(values):
+    """The items of a Vector holding values, a numpy array, an array.array or 
+    any iterable of Python numbers. Integers stay integers unless there is a 
+    float among them, comparison results (bools) become integers."""
+    if numpy is not None:
+        items = numpy.asarray(values if isinstance(values, (numpy.ndarray, 
+                              array, list)) else list(values))
+        if items.dtype.kind == "f":
+            return items.astype(numpy.float64, copy=False)
+        if items.dtype.kind in "biu" or not items.size:
+            return items.astype(numpy.int64, copy=False)
+        raise TypeError("Vector items must be numbers")
+    if isinstance(values, array):
+        return values
+    if not isinstance(values, list):
+        values = list(values)
+    try:
+        return array("q", values)
+    except TypeError: # a float among them
+        return array("d", values)
+        
 class Stack:
-    """Data stack that exists during execution of a PSIL program."""
+    """Data stack that exists during execution of a PSIL program.
+    
+    All views of one stack share a single list. A view only remembers where 
+    its part of the list starts, so pushing and popping cost the same however
+    many views are stacked up below."""
+    __slots__ = ("items", "base")
+    
     def __init__(self, size=None, stack=None):
-        if size and stack:
-            # initialize a shallow copy of a stack with a smaller size
-            self.stack = stack
-            self.size = size
+        if stack is not None:
+            # initialize a view of the top size items of a stack
+            self.items = stack.items
+            self.base = len(self.items)-size
         else:
             # new stack, original copy
-            self.stack = []
-            self.size = 0
+            self.items = []
+            self.base = 0
+            
+    @property
+    def size(self):
+        return len(self.items)-self.base
     
     def append(self, data):
         if not isinstance(data, Namespace):
             raise TypeError("Cannot push, "+str(data)+" is not a Namespace!")
         else:
-            self.stack.append(data)
-            self.size += 1
+            self.items.append(data)
     
     def pop(self):
-        if self.size <= 0:
+        if len(self.items) <= self.base:
             raise IndexError("Tried to pop from empty stack")
         else:
-            val = self.stack.pop()    
-            self.size -= 1
-        return val
+            return self.items.pop()
         
     def peek(self):
         """Return the top item without removing it."""
-        if self.size <= 0:
+        if len(self.items) <= self.base:
             raise IndexError("Tried to peek from empty stack")
         else:
-            if isinstance(self.stack, Stack):
-                return self.stack.peek()
-            else:
-                return self.stack[-1]
-
-    def _str(self, size):
-        if isinstance(self.stack, list):
-            return str(self.stack[-size:])
-        else:
-            return self.stack._str(size)
+            return self.items[-1]
             
     def __str__(self):
-        return self._str(self.size)
\ No newline at end of file
+        return str(self.items[self.base:])
+        
+def footprint(obj):
+    """Bytes of memory held by obj itself.
+    
+    Counts the object and its own namespace dict, not the shared EMPTY one or
+    anything the object merely refers to."""
+    size = sys.getsizeof(obj)
+    names = getattr(obj, "dict", EMPTY)
+    if names is not EMPTY and not isinstance(obj, Scope):
+        size += sys.getsizeof(names)
+        if type(names) is not dict: # frozen, count the dict behind the view
+            size += sys.getsizeof(dict(names))
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
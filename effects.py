@@ -0,0 +1,242 @@
+"""Stack effects and operand types of PSIL code, worked out before it runs.
+
+Most builtins always take the same number of values off the stack and leave
+the same number on it, they say so in their effect (data.LLCode). From those
+and the pushes and calls of a compiled body, check follows what a program
+does to its stack without running it, and reports a builtin that is certain
+to run short of values before any of the program has run:
+
+    (1 add)         ArityError: add takes 2 values, 1 on the stack at the
+                    top level
+
+Only what is certain to run is followed: the instructions of the program up
+to the first one whose effect can not be known (running a value from the
+stack, a builtin like if, a name that might name something else by then),
+and in the same way the code literals it calls through names bound once, by
+a def at the top level. Anything the check does not follow is left to fail
+when it runs, as before.
+
+arithmetic finds the expressions made of Math builtins on numbers and names
+only, like ((n 1 sub) 2 mul). The operands of those are numbers whenever
+their names are, so the closures backend writes each as one Python
+expression on the values of the numbers, run after one type check of what
+the names find, without pushing the operands, counting them or calling the
+builtins. Such an expression falls back to its instructions whenever that
+can not be done: a builtin was rebound, a name finds no number or nothing."""
+
+import operator
+from collections import Counter
+
+import bytecode, data, stdlib
+
+## Python operators of the functions of the Math builtins, on numbers they
+## give what the builtins give
+OPERATORS = {operator.add: "+", operator.sub: "-", operator.mul: "*",
+             operator.truediv: "/", operator.mod: "%", operator.lt: "<",
+             operator.gt: ">", operator.le: "<=", operator.ge: ">=",
+             operator.eq: "=="}
+
+class ArityError(TypeError):
+    """A builtin certain to run with fewer values on the stack than it
+    takes."""
+
+def bodies(program):
+    """The Bytecode of program and of every code literal in it, at any
+    depth."""
+    found, seen = [program], {id(program)}
+    for body in found:
+        ops, consts = body.ops, body.consts
+        for pc in range(0, len(ops), 2):
+            if ops[pc] not in (bytecode.PUSH, bytecode.CALL, bytecode.TCALL):
+                continue
+            value = consts[ops[pc+1]]
+            if isinstance(value, data.Code) and \
+               not isinstance(value, data.LLCode):
+                try:
+                    compiled = value.compiled()
+                except SyntaxError: # can never run, left to fail if it does
+                    continue
+                if id(compiled) not in seen:
+                    seen.add(id(compiled))
+                    found.append(compiled)
+    return found
+
+def pushed(program):
+    """How many times each name is the last of a Reference pushed as a value
+    somewhere in program.
+
+    def takes the name it binds off the stack, so the names never pushed are
+    never bound by the program, whatever it runs."""
+    names = Counter()
+    for body in bodies(program):
+        ops, consts = body.ops, body.consts
+        for pc in range(0, len(ops), 2):
+            if ops[pc] == bytecode.PUSH:
+                value = consts[ops[pc+1]]
+                if isinstance(value, data.Reference):
+                    names[value.last] += 1
+    return names
+
+def check(program, given=0, state=None):
+    """Raise ArityError if running the Bytecode program on a stack of given
+    values is certain to run a builtin short of values, see the module
+    documentation.
+
+    state is the psil.Interpreter about to run it, it tells whether names
+    bound before still find their builtins from its current environment
+    (Interpreter.finds). Without it any name bound anywhere might name 
+    something else."""
+    Checker(pushed(program), state).body(program, given, "at the top level",
+                                         True)
+
+class Checker:
+    """Follows the stack of the bodies a program is certain to run."""
+    def __init__(self, pushed, state=None):
+        self.pushed = pushed
+        self.state = state
+        self.defs = {} # name -> code literal, bound by the top level so far
+        self.known = {} # (id of body, values given) -> values left or None
+
+    def named(self, reference):
+        """What reference surely finds when the code runs, a builtin or a
+        code literal, or None."""
+        if len(reference.names) != 1:
+            return None
+        name = reference.first
+        if name in self.defs: # bound by that def and nothing else
+            return self.defs[name] if self.pushed[name] == 1 else None
+        if self.pushed[name]:
+            return None
+        found = stdlib.builtins.get(name)
+        if not isinstance(found, data.LLCode):
+            return None
+        if data.version(name) and (self.state is None or 
+                                   not self.state.finds(reference, found)):
+            return None # bound before the program, maybe shadowing it
+        return found
+
+    def body(self, body, given, where, top=False):
+        """The number of values running body on given values leaves, None if
+        that can not be known. where says where it runs, for errors."""
+        key = (id(body), given)
+        if key in self.known:
+            return self.known[key]
+        self.known[key] = None # until known, also for calls of itself
+        left = self.run(body, given, where, top)
+        self.known[key] = left
+        return left
+
+    def run(self, body, given, where, top):
+        ops, consts = body.ops, body.consts
+        depth = given # values on the stack of the body
+        counts = [0] # sizes of the open expressions, as Interpreter keeps
+        for pc in range(0, len(ops), 2):
+            op = ops[pc]
+            if op == bytecode.PUSH:
+                depth += 1
+                counts[-1] += 1
+                continue
+            elif op == bytecode.NEW:
+                counts.append(0)
+                continue
+            elif op == bytecode.FOLD: # what it replaced follows, same effect
+                continue
+            elif op in (bytecode.END, bytecode.BACK):
+                return depth
+            elif op in (bytecode.EXEC, bytecode.TEXEC) or len(counts) < 2:
+                return None
+            value = consts[ops[pc+1]]
+            if isinstance(value, data.Reference):
+                name, code = value.string, self.named(value)
+            else:
+                name, code = "a code literal", value
+            if isinstance(code, data.LLCode):
+                if code.effect is None:
+                    return None
+                takes, leaves = code.effect
+                if depth < takes:
+                    raise ArityError("{} takes {} value{}, {} on the stack {}"
+                                     .format(name, takes,
+                                             "s"[:takes != 1], depth, where))
+                depth += leaves - takes
+                count = counts.pop() + leaves - takes
+                counts[-1] += count
+                if top and code is stdlib.builtins["def"]:
+                    self.define(ops, consts, pc)
+            elif isinstance(code, data.Code):
+                size = counts.pop()
+                if not 0 <= size <= depth:
+                    return None
+                left = self.body(code.compiled(), size,
+                                 "in {} (called {})".format(name, where))
+                if left is None:
+                    return None
+                depth += left - size
+                counts[-1] += left
+            else:
+                return None
+        return None
+
+    def define(self, ops, consts, pc):
+        """Note the code literal bound by (name {...} def), ending with the
+        call at pc."""
+        if pc < 6 or ops[pc-6] != bytecode.NEW or \
+           ops[pc-4] != bytecode.PUSH or ops[pc-2] != bytecode.PUSH:
+            return
+        name, value = consts[ops[pc-3]], consts[ops[pc-1]]
+        if isinstance(name, data.Reference) and len(name.names) == 1 and \
+           isinstance(value, data.Code) and \
+           not isinstance(value, data.LLCode):
+            self.defs[name.first] = value
+
+def arithmetic(ops, consts):
+    """The expressions of the body with ops and consts made of Math builtins
+    only, outermost ones, as {offset of their NEW: (tree, offset after
+    them)}.
+
+    A tree is (name, builtin, left, right), its operands are numbers,
+    References, parse.Folds of numbers or trees again."""
+    found = {}
+    pc = 0
+    while pc < len(ops):
+        tree = expression(ops, consts, pc)
+        if tree is not None:
+            found[pc] = tree
+            pc = tree[1] # nothing inside it is found again
+        else:
+            pc += 2
+    return found
+
+def expression(ops, consts, pc):
+    """The tree of the expression of Math builtins starting at pc and the
+    offset after it, or None."""
+    if ops[pc] != bytecode.NEW:
+        return None
+    pc += 2
+    operands = []
+    while ops[pc] in (bytecode.PUSH, bytecode.NEW, bytecode.FOLD):
+        if ops[pc] == bytecode.NEW:
+            inner = expression(ops, consts, pc)
+            if inner is None:
+                return None
+            operand, pc = inner
+        else:
+            operand = consts[ops[pc+1]]
+            if ops[pc] == bytecode.FOLD:
+                if not isinstance(operand.value, data.Numeric):
+                    return None
+                pc += operand.skip
+            elif not isinstance(operand, (data.Numeric, data.Reference)):
+                return None
+            pc += 2
+        operands.append(operand)
+    if ops[pc] not in (bytecode.CALL, bytecode.TCALL) or len(operands) != 2:
+        return None
+    reference = consts[ops[pc+1]]
+    if not isinstance(reference, data.Reference) or \
+       len(reference.names) != 1:
+        return None
+    code = stdlib.builtins.get(reference.first)
+    if not isinstance(code, stdlib.Math) or code.function not in OPERATORS:
+        return None
+    return (reference.first, code) + tuple(operands), pc+2
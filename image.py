@@ -0,0 +1,158 @@
+"""Saved images of what PSIL programs defined, for starting warm.
+
+A program that begins by running a large prelude of definitions spends most
+of its time on them: parsing the prelude and every code literal body, then
+running all of its def expressions. An image is the result of that, saved
+once: the names the prelude bound at the top level and everything reachable
+from them, with the compiled bodies of every code literal, pickled into one
+file. Loading it is a single pickle.load, giving a read only namespace
+(data.library) to use as the library of any number of Interpreters (psil.py
+--save-image and --image).
+
+Builtins are not saved, only their names, the loading process puts its own
+in their place. Code literals keep their Bytecode and their span of the
+source they came from, saved once for all of them: the bytecode interpreter
+runs them without parsing anything, the reference loop parses the span when
+it first runs them. The lookup caches of references are left out, they only
+mean something in the process that filled them. Images are pickles, only load
+images from where you would run code from."""
+
+import pickle
+from types import MappingProxyType
+
+import bytecode, data, parse, stdlib
+
+FORMAT = 2 # changed whenever images of older versions can not be loaded
+
+def frozen(names):
+    """Read only view of names, how shared literals keep theirs."""
+    return MappingProxyType(names)
+
+def frame(names):
+    """A Frame handed out as a value (by get), with the names it had."""
+    env = data.Frame(data.Stack())
+    env.dict = names
+    env.escaped = True
+    return env
+
+def code(source, span, names, body):
+    """A code literal with its compiled body."""
+    literal = data.Code.__new__(data.Code)
+    literal.source = source
+    literal.span = span
+    literal.dict = names
+    literal.parent = None
+    literal.bytecode = body
+    return literal
+
+def reference(string, names):
+    found = data.Reference(string)
+    found.dict = names
+    return found
+
+class Pickler(pickle.Pickler):
+    """Pickles a namespace graph, saving builtins and EMPTY by name.
+
+    The types there are most of are saved as the arguments of a function
+    making them again, which is smaller and faster to load than their
+    attributes."""
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.builtins = {id(value): name
+                         for name, value in stdlib.builtins.items()
+                         if isinstance(value, (data.LLCode, data.Handle))}
+
+    def reducer_override(self, obj):
+        kind = type(obj)
+        if kind is data.Code:
+            return code, (obj.source, obj.span, obj.dict, obj.compiled())
+        if kind is parse.Source:
+            return parse.Source, (obj.text,)
+        if kind is data.Reference:
+            return reference, (obj.string, obj.dict)
+        if (kind is data.Integer or kind is data.Float) and \
+           obj.dict is data.EMPTY:
+            return data.number, (obj.val,)
+        if kind is bytecode.Bytecode:
+            return bytecode.Bytecode, (obj.ops, obj.consts)
+        if kind is MappingProxyType:
+            return frozen, (dict(obj),)
+        if kind is data.Frame:
+            return frame, (obj.dict,)
+        return NotImplemented
+
+    def persistent_id(self, obj):
+        if obj is data.EMPTY:
+            return "EMPTY"
+        name = self.builtins.get(id(obj))
+        if name is not None:
+            return ("builtin", name)
+        return None
+
+class Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid == "EMPTY":
+            return data.EMPTY
+        kind, name = pid
+        if kind != "builtin" or name not in stdlib.builtins:
+            raise pickle.UnpicklingError("Image needs unknown builtin "+
+                                         repr(name))
+        return stdlib.builtins[name]
+
+def compile_all(names):
+    """Compile the body of every code literal reachable from names."""
+    seen = set()
+    values = list(names.values())
+    while values:
+        value = values.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, stdlib.Memo):
+            values.append(value.code)
+        elif isinstance(value, data.Code) and \
+             not isinstance(value, data.LLCode):
+            values.extend(value.compiled().consts)
+        if isinstance(value, data.Namespace):
+            values.extend(value.dict.values())
+
+def bound(interpreter):
+    """The names visible at the top level of interpreter, besides the
+    builtins: its own and those of the libraries it was given."""
+    chain = []
+    ns = interpreter.top
+    while ns is not None and ns is not stdlib.namespace:
+        chain.append(ns)
+        ns = ns.parent
+    names = {}
+    for ns in reversed(chain): # nearer ones shadow those further up
+        names.update(ns.dict)
+    return names
+
+def save(interpreter, path):
+    """Save the names interpreter has at the top level as an image at path.
+
+    Along with them go the names bound anywhere in this process so far, so
+    folds of builtins they shadow look the names up after loading (see
+    optimize)."""
+    names = bound(interpreter)
+    compile_all(names)
+    with open(path, "wb") as f:
+        Pickler(f).dump((FORMAT, sorted(data.versions), names))
+
+def load(path, parent=None):
+    """The names in the image at path, as a data.library with parent
+    (default the builtins, stdlib.namespace) as its parent."""
+    with open(path, "rb") as f:
+        try:
+            saved = Unpickler(f).load()
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, IndexError) as e:
+            raise ValueError(path+" is not a PSIL image: "+str(e))
+    if not isinstance(saved, tuple) or len(saved) != 3 or \
+       saved[0] != FORMAT:
+        raise ValueError(path+" is not a PSIL image of this version")
+    _, rebound, names = saved
+    for name in rebound:
+        data.versions[name] = next(data._stamps)
+    return data.library(names, parent or stdlib.namespace)
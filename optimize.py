@@ -0,0 +1,83 @@
+"""Optimizer for parsed PSIL code, run between parse.parse and bytecode.compile.
+
+An expression applying a pure builtin to literals, like (3 4 mul), gives the
+same value every time it runs, yet each run starts an expression, pushes the
+literals, looks up the name and calls the builtin. fold works such expressions
+out once, innermost first, so ((n 1 sub) (2 3 add) mul) keeps one of its
+three, and replaces them by a parse.Fold instruction holding the result.
+
+Names are looked up when the code runs, so a Fold is only right as long as its
+names find the builtins it was worked out with. A Fold keeps the instructions
+it replaced and checks its names each time it runs (Interpreter.finds), 
+running those instead where one finds something else. The check is keyed on 
+where the name is found from the running code: while nothing anywhere bound 
+the name (data.version 0) it costs nothing, a def of the name in a record, or
+by another interpreter of the process, only makes it look the name up."""
+
+import data, parse
+
+def builtin(reference):
+    """The pure builtin reference names, or None.
+
+    stdlib imports data, which imports bytecode and so this module, it is
+    imported here when first needed."""
+    import stdlib
+    if len(reference.names) != 1:
+        return None
+    found = stdlib.builtins.get(reference.first)
+    if isinstance(found, data.LLCode) and found.pure:
+        return found
+    return None
+
+def constant(inst):
+    """The value a Push or Fold instruction puts on the stack, if a literal."""
+    if isinstance(inst, parse.Fold):
+        return inst.value
+    if isinstance(inst, parse.Push) and \
+       not isinstance(inst.value, (data.Reference, data.Code)):
+        return inst.value
+    return None
+
+def fold(instructions):
+    """Optimized list of the instructions, see the module documentation.
+
+    The result is a new list, instructions is not changed."""
+    result = []
+    starts = [] # index in result of each open NewExpression
+    for inst in instructions:
+        if isinstance(inst, parse.NewExpression):
+            starts.append(len(result))
+        elif isinstance(inst, parse.Execute) and starts:
+            start = starts.pop()
+            folded = expression(result[start+1:])
+            if folded is not None:
+                folded.instructions = result[start:] + [inst]
+                del result[start:]
+                result.append(folded)
+                continue
+        result.append(inst)
+    return result
+
+def expression(body):
+    """A Fold for an expression with body between its parentheses, or None.
+
+    The last instruction of body pushes what the expression runs, the rest
+    push its arguments."""
+    if not body or not isinstance(body[-1], parse.Push) or \
+       not isinstance(body[-1].value, data.Reference):
+        return None
+    code = builtin(body[-1].value)
+    if code is None:
+        return None
+    values = [constant(inst) for inst in body[:-1]]
+    if any(value is None for value in values):
+        return None
+    value = code.fold(values)
+    if value is None:
+        return None
+    builtins = {body[-1].value.first: code}
+    for inst in body[:-1]:
+        if isinstance(inst, parse.Fold):
+            builtins.update((reference.first, used)
+                            for reference, used in inst.uses)
+    return parse.Fold(value, builtins, None)
@@ -4,6 +4,8 @@ Part of Timothy Hewitt's UTD REx 2015 project.
 Author: Timothy Hewitt
 Date: 2105-03-20"""
 
+import mmap, re
+
 import data
 
 ## The purpose of a lexer and parser is to turn the source code into a series of
@@ -26,68 +28,186 @@ TOKENTEST = """
 (((cheese grill) pizza) 0.45)
 """ # Not a comprehensive test, but should find most issues
 
-def preprocess(char_stream):
-    """Preprocess the inbound character stream.
-    
-    This removes comments and spaces out tokens."""
-    for c in char_stream:
-        if c == "#":
-            Comment.munch(char_stream)
-            continue # no need to pass comments on to tokenizer
-        elif c in ")}":
-            yield " "
-        elif c in "({":
-            yield c 
-            c = " "
-        elif c == "\n":
-            continue # newlines mean nothing
-        yield c # this means that the ')' and '}' are passed back 
+BLOCK_SIZE = 1 << 16 # characters per read when loading source files
 
-def tokenize(char_stream):
-    """tokenize the character stream.
-    
-    Tried to use regular expressions to do this, but tokenizing a context free 
-    language is impossible with a regex tokenizer."""
+_SPACE = re.compile(r"(?:[ \t\r\n\f\v]+|\#[^#]*\#)*") # whitespace, comments
+_TOKEN = re.compile(r"""(\()|(\))                     # ( and )
+                        |([^ \t\r\n\f\v(){}\[\]#"]+)  # reference or number
+                        |([^ \t\r\n\f\v])             # anything else
+                     """, re.X)
+_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"', re.S)
+_ESCAPE = re.compile(r"\\(?:\n[ \t\r\n\f\v]*|(.))", re.S)
+_WORD = re.compile(r"[^ \t\r\n\f\v]+")
+_BRACES = re.compile(r'[{}"#]') # everything that matters inside a code literal
+_NUMBER = re.compile(r"[0-9]*\.?[0-9]*")
+_NAME = re.compile(r"[:a-zA-Z]*")
+
+def _error(message, pos):
+    """Make a SyntaxError carrying the source offset of the problem."""
+    e = SyntaxError(message)
+    e.offset = pos
+    return e
+
+def tokenize(source, start=0, end=None):
+    """tokenize a source string.
     
-    preproc = preprocess(char_stream)
-    for c in preproc:
-        if c in " \t\n": # Whitespace not inside a string literal
-            continue # run to the next iteration
-        elif c == "(": # start new expression
-            yield StartExpression(c)
-        elif c == ")": # finish expression
-            yield EndExpression(c)
-        elif c == "{":
-            yield Code.munch(preproc) # eats end curly brace
-        else: # Reference, numeric literal, string, or error
-            if c == "\"": # Beginning of string literal
-                yield String.munch(preproc) # eats end quote
-            elif c.isdigit() or c in ".-+": # numeric literal
-                yield Numeric.munch(c, preproc) # c is the first character
+    Scans the whole buffer with one compiled regex per token instead of 
+    pulling characters through a pipeline of generators. Comments and newlines
+    are whitespace, string literals are taken verbatim apart from their 
+    escapes. source is a string or a Source, of which only source[start:end]
+    is scanned (a code literal body), every token records its start and end
+    offsets in the whole source."""
+    if not isinstance(source, Source):
+        source = Source(source)
+    text = source.text
+    if end is None:
+        end = len(text)
+    skip, match = _SPACE.match, _TOKEN.match
+    pos = start
+    while True:
+        pos = skip(text, pos, end).end()
+        if pos >= end: # nothing but whitespace and comments left
+            return
+        m = match(text, pos, end)
+        kind = m.lastindex
+        start = m.start(kind)
+        pos = m.end()
+        if kind == 1: # start new expression
+            yield StartExpression("(", start, pos)
+        elif kind == 2: # finish expression
+            yield EndExpression(")", start, pos)
+        elif kind == 3: # Reference, numeric literal, or error
+            c = text[start]
+            if c.isdigit() or c in ".-+": # numeric literal
+                yield Numeric.munch(text, start, pos)
             else: # Reference or syntax error
-                yield Reference.munch(c, preproc) # c is the first character
+                yield Reference.munch(text, start, pos)
+        else:
+            c = text[start]
+            if c == "{":
+                token = Code.munch(source, start, end) # eats end curly brace
+            elif c == "\"": # Beginning of string literal
+                token = String.munch(text, start, end) # eats end quote
+            elif c == "[":
+                token = Vector.munch(text, start, end) # eats end bracket
+            elif c == "#":
+                raise _error("Unclosed comment in parsed code!", start)
+            else:
+                raise _error("Unmatched '"+c+"' in parsed code!", start)
+            pos = token.end
+            yield token
                 
-def parse(char_stream):
-    """Parse an incoming character stream.
+def parse(source, start=0, end=None):
+    """Parse PSIL source code.
     
-    generates a stream of Instruction objects."""
-    tokens = tokenize(char_stream)
+    source is a string, a Source or any iterable of characters (which is 
+    joined into one first), start and end as for tokenize. generates a stream
+    of Instruction objects."""
+    if not isinstance(source, (str, Source)):
+        source = "".join(source)
+    tokens = tokenize(source, start, end)
     for t in tokens:
         yield t.evaluate()
         
+def read(file, size=BLOCK_SIZE):
+    """Read a whole file like object into a string, size characters a time.
+    
+    Files on disk are mapped into memory and decoded in one go instead, 
+    without the blocks and their copies."""
+    try:
+        text = _mapped(file)
+    except (AttributeError, OSError, ValueError):
+        text = None # not a file on disk, an empty one, or not at its start
+    if text is not None:
+        return text
+    blocks = []
+    block = file.read(size)
+    while block:
+        blocks.append(block)
+        block = file.read(size)
+    return "".join(blocks)
+    
+def _mapped(file):
+    """The text of file, through mmap, or None if it was read from already."""
+    if file.tell() != 0:
+        return None
+    encoding = getattr(file, "encoding", None) or "utf-8"
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            text = str(view, encoding)
+    file.seek(0, 2) # read to the end, as file.read would have
+    if "\r" in text: # the universal newlines of text files
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+    
 def chars(file):
     """turns a file like object into a character stream"""
-    for line in file:
-        for c in line:
-            yield c
+    return iter(read(file))
+                
+class Source:
+    """The text of a program, of which code literals are spans.
+    
+    Code literals keep the Source and their offsets in it, their bodies are 
+    only scanned when first run, however deeply nested. Where a literal ends 
+    is looked up in ends, made by one scan over the whole text when first 
+    needed, instead of scanning its body again at every level of nesting."""
+    __slots__ = ("text", "_ends")
+    
+    def __init__(self, text):
+        self.text = text
+        self._ends = None
+        
+    def closing(self, pos):
+        """Offset just past the } closing the { at pos, or None if the text 
+        is wrong before it closes."""
+        if self._ends is None:
+            self._ends = self.ends() # threads doing this at once get equal ones
+        return self._ends.get(pos)
+        
+    def ends(self):
+        """Map the offset of every { to the offset just past its }.
+        
+        Braces in strings and comments do not count, scanning stops at an 
+        unterminated one, tokenize reports it when it gets there."""
+        text = self.text
+        search = _BRACES.search
+        ends = {}
+        opened = []
+        pos = 0
+        while True:
+            match = search(text, pos)
+            if not match:
+                return ends
+            c = match.group()
+            pos = match.end()
+            if c == "{":
+                opened.append(pos-1)
+            elif c == "}":
+                if opened: # an unmatched one is tokenize's to report
+                    ends[opened.pop()] = pos
+            elif c == "\"":
+                match = _STRING.match(text, pos-1)
+                if not match:
+                    return ends
+                pos = match.end()
+            else:
+                pos = text.find("#", pos)+1
+                if not pos:
+                    return ends
                 
+    def __len__(self):
+        return len(self.text)
+        
 class Token:
     """Superclass for lexical elements of the language.
     
     Any discrete element of the language will have an abstraction that 
-    subclasses this one."""
-    def __init__(self, string):
+    subclasses this one. start and end are the offsets of the token in the 
+    source it was scanned from."""
+    def __init__(self, string, start=None, end=None):
         self.string = string
+        self.start = start
+        self.end = end
         
     def evaluate(self):
         """Turns Token into an Instruction."""
@@ -95,30 +215,25 @@ class Token:
         
 class Comment(Token):
     """Never need to instance, just nice to have."""
-    def munch(iter):
-        for c in iter:
-            if c == "#":
-                return # comments mean nothing, just need to push the iterator over them
-        raise SyntaxError("Unclosed comment in parsed code!")
+    def munch(source, pos, end=None):
+        """Returns the offset just past the comment starting at pos."""
+        close = source.find("#", pos+1, end)
+        if close < 0:
+            raise _error("Unclosed comment in parsed code!", pos)
+        return close+1
 
 class Reference(Token):
     """A reference to some namespace in the namespace tree.
     
     May or may not be valid, Token objects just translate from strings to 
     abstractions."""
-    def munch(c, iter):
-        chars = [c]
-        for c in iter:
-            if c in " \n\t":
-                break
-            if c == ":" or c.isalpha():
-                chars.append(c)
-            else:
-                raise SyntaxError("Invalid character in reference: "+c)
-        return Reference("".join(chars))
-        
-    def __init__(self, string):
-        self.string = string
+    def munch(source, pos, end):
+        """The reference is source[pos:end], its first character unchecked."""
+        name = _NAME.match(source, pos+1, end).end()
+        if name < end:
+            raise _error("Invalid character in reference: "+source[name], 
+                         name)
+        return Reference(source[pos:end], pos, end)
     
     def evaluate(self):
         return Push(data.Reference(self))
@@ -142,26 +257,23 @@ class EndExpression(Token):
         return "PSIL Expression, size: "+str(self.size)
 
 class Literal(Token):
-    """Superclass for Numeric, Text, and Code Literals."""
+    """Superclass for Numeric, Text, Vector and Code Literals."""
     
 class String(Literal):
     """Token for a string literal."""
-    def munch(iter):
-        chars = []
-        escape = False
-        for c in iter:
-            if escape:
-                chars.append(c)
-            elif c == "\\":
-                escape = True
-            elif c == "\"":
-                return String("".join(chars))
-            else:
-                chars.append(c)
-        raise SyntaxError("Reached end of source string parsing string literal")
+    def munch(source, pos, end=None):
+        """Scans the string literal whose opening quote is at pos.
         
-    def __init__(self, string):
-        self.string = string
+        A backslash escapes the next character, a backslash before a newline 
+        swallows the newline and the indentation after it."""
+        match = _STRING.match(source, pos, len(source) if end is None else end)
+        if not match:
+            raise _error("Reached end of source string parsing string literal",
+                         pos)
+        string = match.group(1)
+        if "\\" in string:
+            string = _ESCAPE.sub(lambda m: m.group(1) or "", string)
+        return String(string, pos, match.end())
         
     def __str__(self):
         return "PSIL String Token: "+self.string
@@ -171,48 +283,91 @@ class String(Literal):
     
     
 class Code(Literal):
-    """Token for code literals."""
-    def munch(iter):
-        chars = []
+    """Token for code literals.
+    
+    A span of source, a Source: the offsets include the braces, the string is
+    the body between them, only copied out when asked for."""
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+        
+    @property
+    def string(self):
+        return self.source.text[self.start+1:self.end-1]
+        
+    def munch(source, pos, end=None):
+        """Scans the code literal whose opening brace is at pos, up to end.
+        
+        Braces inside strings and comments in the body do not count."""
+        close = source.closing(pos)
+        if close is not None and (end is None or close <= end):
+            return Code(source, pos, close)
+        text = source.text # wrong somewhere, scan to find out where
         lev = 1
-        for c in iter:
+        scan = pos+1
+        while True:
+            match = _BRACES.search(text, scan, len(text) if end is None 
+                                                else end)
+            if not match:
+                raise _error("Reached end of source string parsing code "
+                             "literal", pos)
+            c = match.group()
+            scan = match.end()
             if c == "{":
                 lev += 1
             elif c == "}":
-                if lev == 1: # match for starting brace!
-                    return Code("".join(chars))
                 lev -= 1
-            chars.append(c) # always add the character to the literal
+                if lev == 0: # match for starting brace!
+                    return Code(source, pos, scan)
+            elif c == "\"":
+                scan = String.munch(text, scan-1, end).end
+            else:
+                scan = Comment.munch(text, scan-1, end)
             
-    def __init__(self, string):
-        self.string = string
-        
     def evaluate(self):
         return Push(data.Code(self))
         
     def __str__(self):
         return "PSIL Code Literal Token: "+self.string
     
+class Vector(Literal):
+    """Token for vector literals, numbers between brackets: [1 2.5 -3]
+    
+    The string is the body between the brackets, the offsets include them."""
+    def munch(source, pos, end=None):
+        """Scans the vector literal whose opening bracket is at pos."""
+        close = source.find("]", pos+1, end)
+        if close < 0:
+            raise _error("Reached end of source string parsing vector literal",
+                         pos)
+        for word in _WORD.finditer(source, pos+1, close):
+            c = word.group()[0]
+            if not (c.isdigit() or c in ".-+"):
+                raise _error("Non-Numeric in vector literal", word.start())
+            Numeric.munch(source, word.start(), word.end())
+        return Vector(source[pos+1:close], pos, close+1)
+        
+    def evaluate(self):
+        return Push(data.Vector(self))
+        
+    def __str__(self):
+        return "PSIL Vector Token: "+self.string
+    
 class Numeric(Literal):
     """Superclass for Numeric literals."""
-    def munch(c, iter):
-        chars = [c] # c is the character eaten by the tokenizer
-        float = False
-        for c in iter:
-            if c in " \n\t":
-                break
-            if c == ".":
-                if not float:
-                    float = True
-                else:
-                    raise SyntaxError("Invalid numeric literal: Too many '.'")
-            elif not c.isdigit():
-                raise SyntaxError("Non-Digit in Numeric Literal")
-            chars.append(c)
-        if float:
-            return Float("".join(chars))
+    def munch(source, pos, end):
+        """The literal is source[pos:end], pos holding a digit or one of .-+"""
+        number = _NUMBER.match(source, pos+1, end).end()
+        if number < end: # the pattern allows a single '.'
+            if source[number] == ".":
+                raise _error("Invalid numeric literal: Too many '.'", number)
+            raise _error("Non-Digit in Numeric Literal", number)
+        string = source[pos:end]
+        if "." in string:
+            return Float(string, pos, end)
         else:
-            return Integer("".join(chars))
+            return Integer(string, pos, end)
     
 class Integer(Numeric):
     """Token for Integer literals."""
@@ -266,6 +421,36 @@ class Execute(Instruction):
     def __str__(self):
         return "EXECUTE"
 
+class Fold(Instruction):
+    """Push value, if the names of the builtins it was worked out with still
+    find them where it runs.
+
+    builtins maps the names to the builtins. instructions are the ones it 
+    replaces, run instead when a name finds something else. skip is set by 
+    bytecode.compile to the length of their compiled form. Made by 
+    optimize.fold."""
+    def __init__(self, value, builtins, instructions):
+        self.value = value
+        self.names = tuple(sorted(builtins))
+        self.uses = tuple((data.Reference(name), builtins[name])
+                          for name in self.names)
+        self.instructions = instructions
+        self.skip = 0
+
+    def valid(self, state):
+        """Whether the names find the builtins folded from the current 
+        environment of state, a psil.Interpreter (see its finds)."""
+        for reference, builtin in self.uses:
+            if not state.finds(reference, builtin):
+                return False
+        return True
+
+    def __repr__(self):
+        return repr(self.value)+" from "+" ".join(self.names)
+
+    def __str__(self):
+        return "FOLD "+str(self.value)
+
 if __name__ == "__main__":
-    for i in parse(iter(TOKENTEST)):
+    for i in parse(TOKENTEST):
         print(i)
\ No newline at end of file
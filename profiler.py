@@ -0,0 +1,185 @@
+"""Profiler for PSIL programs.
+
+cProfile sees the interpreter loop, not the PSIL code it runs. This module is
+told by Interpreter.execute whenever a code literal or builtin is entered or
+left, and keeps calls, executed instructions and time for each of them.
+
+Code literals are told apart by their source span and the name they were
+called by, builtins by name. Time is measured around each call: self time
+excludes the callees, cumulative time includes them, counted once for
+recursive calls (only the outermost call of a literal adds to it)."""
+
+import bisect, time
+
+## columns of Profiler.stats rows
+CALLS, OPS, CUM_OPS, SELF, CUMULATIVE = range(5)
+
+## report sort orders -> column, the name order sorts by label instead
+SORTS = {
+    "calls": CALLS,
+    "ops": OPS,
+    "cumops": CUM_OPS,
+    "self": SELF,
+    "cumulative": CUMULATIVE,
+    "name": None,
+    }
+
+PROGRAM = ("<program>", None) # key of the top level of the program
+
+class Profiler:
+    """Collects per code literal and per builtin statistics of one run.
+
+    stats maps (name, span) to [calls, ops, cumulative ops, self seconds,
+    cumulative seconds], span being None for builtins and the program itself.
+    ops only counts the instructions of the body itself, builtins have none.
+    stacks maps call stacks to the self time spent in them, for collapsed 
+    stack output. A call stack is an index into paths, which holds a 
+    (caller's stack, label) pair for each one seen."""
+    def __init__(self, source="", filename="<source>"):
+        self.filename = filename
+        self.newlines = [i for i, c in enumerate(source) if c == "\n"]
+        self.stats = {}
+        self.stacks = {}
+        self.paths = [] # stack -> (caller's stack, label)
+        self.path_index = {} # (caller's stack, label) -> stack
+        self.labels = {}
+        self.active = {} # key -> calls of it currently running
+        self.stack = [] # [key, start, child time, child ops, path] per call
+        self.counted = 0 # ops given to some body so far
+        self.clock = time.perf_counter
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self.started = self.clock()
+        self.push(PROGRAM)
+
+    def stop(self, ops):
+        """End the run, the program itself gets the ops not given to a body."""
+        while len(self.stack) > 1:
+            self.pop(0)
+        if self.stack:
+            self.pop(ops - self.counted)
+        self.elapsed += self.clock() - self.started
+
+    def push(self, key):
+        step = (self.stack[-1][4] if self.stack else None, self.label(key))
+        path = self.path_index.get(step)
+        if path is None:
+            path = self.path_index[step] = len(self.paths)
+            self.paths.append(step)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.stack.append([key, self.clock(), 0.0, 0, path])
+
+    def pop(self, ops):
+        now = self.clock()
+        key, start, child_time, child_ops, path = self.stack.pop()
+        total = now - start
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0, 0, 0.0, 0.0]
+        stats[CALLS] += 1
+        stats[OPS] += ops
+        stats[SELF] += total - child_time
+        self.counted += ops
+        self.active[key] -= 1
+        if not self.active[key]: # outermost call of a recursion
+            stats[CUM_OPS] += ops + child_ops
+            stats[CUMULATIVE] += total
+        if self.stack:
+            self.stack[-1][2] += total
+            self.stack[-1][3] += ops + child_ops
+        self.stacks[path] = self.stacks.get(path, 0.0) + total - child_time
+
+    ## hooks called by Interpreter.execute
+
+    def enter(self, code, reference):
+        """A code literal was called, through reference if not None."""
+        name = "<anonymous>" if reference is None else str(reference)
+        self.push((name, code.span))
+
+    def tail(self, code, reference, ops):
+        """The running literal made a tail call after ops instructions."""
+        self.pop(ops)
+        self.enter(code, reference)
+
+    def leave(self, ops):
+        """The running literal returned after ops instructions."""
+        self.pop(ops)
+
+    def builtin(self, state, code, reference):
+        """Run the builtin code through state.call_builtin, timing it."""
+        name = type(code).__name__ if reference is None else str(reference)
+        self.push((name, None))
+        try:
+            state.call_builtin(code)
+        finally:
+            self.pop(0)
+
+    def unwind(self, pcs):
+        """An exception is leaving execute, pcs are those of the running bodies.
+
+        Bodies are listed from the program to the innermost, which is the
+        order they are on the profiler's stack in."""
+        for pc in reversed(pcs):
+            self.pop(pc//2)
+
+    ## output
+
+    def location(self, span):
+        """file:line:column of the start of span."""
+        if span is None or span[0] is None:
+            return ""
+        line = bisect.bisect_left(self.newlines, span[0])
+        column = span[0] - (self.newlines[line-1] + 1 if line else 0)
+        return "{}:{}:{}".format(self.filename, line+1, column+1)
+
+    def label(self, key):
+        label = self.labels.get(key)
+        if label is None:
+            name, span = key
+            if span is None or span[0] is None:
+                label = name
+            else:
+                label = name+" "+self.location(span)
+            self.labels[key] = label
+        return label
+
+    def report(self, sort="cumulative", limit=None):
+        """Table of the statistics, sorted by one of SORTS."""
+        column = SORTS[sort]
+        if column is None:
+            keys = sorted(self.stats, key=self.label)
+        else:
+            keys = sorted(self.stats, key=lambda key: self.stats[key][column],
+                          reverse=True)
+        if limit is not None:
+            keys = keys[:limit]
+        total = sum(stats[OPS] for stats in self.stats.values())
+        lines = ["{} instructions in {:.3f} seconds ({:.0f} per second)".format(
+                     total, self.elapsed,
+                     total/self.elapsed if self.elapsed else 0.0),
+                 "",
+                 "{:>9} {:>10} {:>10} {:>9} {:>9} {:>10}  {}".format(
+                     "calls", "ops", "cum ops", "self s", "cum s",
+                     "cum/call s", "code")]
+        for key in keys:
+            calls, ops, cum_ops, self_time, cum_time = self.stats[key]
+            lines.append("{:>9} {:>10} {:>10} {:>9.4f} {:>9.4f} {:>10.6f}  {}"
+                         .format(calls, ops, cum_ops, self_time, cum_time,
+                                 cum_time/calls, self.label(key)))
+        return "\n".join(lines)
+
+    def collapsed(self, file):
+        """Write the call stacks in collapsed format (flamegraph.pl and others).
+
+        One line per stack: the labels separated by semicolons, then the self
+        time spent in it in microseconds."""
+        for path, seconds in self.stacks.items():
+            micros = round(seconds*1e6)
+            if micros:
+                labels = []
+                while path is not None:
+                    path, label = self.paths[path]
+                    labels.append(label)
+                file.write(";".join(reversed(labels))+" "+str(micros)+"\n")
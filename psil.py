@@ -3,23 +3,365 @@
 
 Starts up the interpreter. Also handles file IO for programs."""
 
-import sys
+import argparse, asyncio, sys
 
-import data, parse, stdlib
+import bytecode, closures, data, effects, parse, profiler, stdlib, streams
+
+SLICE = 1000 # instructions run_async lets a program run before the next one
+FRAME_POOL = 256 # most returned frames an interpreter keeps for reuse
 
 class Interpreter:
-    def __init__(self, file):
-        self.char_stream = parse.chars(file)
-        self.env = data.Namespace(data.Stack(), None, **stdlib.builtins)
-        self.op_stream_stack = [parse.parse(self.char_stream)] 
+    def __init__(self, file, reference=False, profiler=None, prefix=">_< ",
+                 buffering=streams.BUFFER_SIZE, error_buffering=0, 
+                 library=None, output="stdout", closures=False):
+        """Set up an interpreter for the program in file.
+        
+        With reference set the program is run by the original tree-of-iterators
+        loop (run_reference) instead of being compiled to bytecode, with 
+        closures set the bytecode is compiled further to Python functions 
+        (closures.execute). All modes share the environment handling and 
+        must produce the same results.
+        A profiler.Profiler given as profiler is told about every call made by
+        the bytecode loop. prefix starts every line of out, buffering is the 
+        buffer size of stdout and of files opened by the program, 
+        error_buffering that of stderr. output is where stdout goes, a file 
+        or the name of one in sys.
+        
+        The top level environment has library as its parent, a read only 
+        namespace made by library() or data.library, or stdlib.namespace, the
+        builtins alone. Interpreters only ever write into their own frames 
+        and into copies of shared values, so any number of them can run at 
+        once in different threads, sharing their library and bytecode.cache.
+        """
+        self.source = parse.read(file)
+        self.env = data.Frame(data.Stack(), library or stdlib.namespace)
+        self.top = self.env
+        self.top.escaped = True # reachable from outside, never reused
+        self.op_stream_stack = [parse.parse(self.source)] 
         self.arg_len_stack = []
+        self.reference = reference
+        self.closures = closures
+        self.ops = 0 # instructions executed so far
+        self.pending = None # call requested by a builtin, see call
+        self.callbacks = {} # stream stack depth -> then, for run_reference
+        self.inlined = {} # stream stack depth -> (then, count) of inline runs
+        self.free_frames = [] # returned frames to reuse, see append_env
+        self.frame_hits = 0 # frames taken from free_frames
+        self.live_frames = 1 # frames in use, the top level and running calls
+        self.peak_frames = 1 # the most there were at once
+        self.profiler = profiler
+        self.prefix = prefix
+        self.buffering = buffering
+        self.stdin = streams.Input("stdin")
+        self.stdout = streams.Output(output, buffering)
+        self.stderr = streams.Output("stderr", error_buffering)
+        self.handles = [] # streams.Output of the files the program opened
         
     def run(self):
         """Run the interpreter
         
-        if file is stdin, interactive mode should be used."""
+        Output still buffered is written out when the program ends, also when
+        it ends in an error, and the files it left open are closed. The 
+        compiled backends first check the program for builtins certain to run
+        short of values (effects.check), raising effects.ArityError before 
+        any of it runs."""
+        try:
+            if self.reference:
+                return self.run_reference()
+            program = bytecode.compile(self.op_stream_stack.pop(),
+                                       bytecode.cache.optimize)
+            effects.check(program, self.env.stack.size, self)
+            if self.closures:
+                return closures.execute(self, program)
+            if self.profiler is None:
+                return self.execute(program)
+            self.profiler.start()
+            try:
+                self.execute(program)
+            finally:
+                self.profiler.stop(self.ops)
+        finally:
+            self.close()
+            
+    async def run_async(self, budget=SLICE):
+        """Run the interpreter as an asyncio coroutine.
+        
+        Gives the event loop a turn about every budget instructions, and 
+        whenever an I/O builtin would block on an asynchronous stream, so any
+        number of programs can run on one event loop without one holding up 
+        the others. Give the program streams.AsyncInput and AsyncOutput as
+        stdin and stdout to read and write through asyncio streams. Only 
+        runs the bytecode interpreter. Ends like run."""
+        if self.reference or self.closures:
+            raise ValueError("run_async needs the bytecode interpreter")
+        try:
+            program = bytecode.compile(self.op_stream_stack.pop(),
+                                       bytecode.cache.optimize)
+            effects.check(program, self.env.stack.size, self)
+            if self.profiler is not None:
+                self.profiler.start()
+            try:
+                for awaitable in self.steps(program, budget):
+                    if awaitable is None:
+                        await asyncio.sleep(0)
+                    else:
+                        await awaitable
+            finally:
+                if self.profiler is not None:
+                    self.profiler.stop(self.ops)
+        finally:
+            self.close()
+            for stream in (self.stdout, self.stderr):
+                if isinstance(stream, streams.AsyncOutput):
+                    await stream.drain()
+            
+    def flush(self):
+        """Write out everything buffered by the program's streams."""
+        for handle in [self.stdout, self.stderr] + self.handles:
+            handle.flush()
+            
+    def close(self):
+        """Flush the standard streams and close the files left open."""
+        self.flush()
+        while self.handles:
+            self.handles.pop().close()
+        
+    def evaluate(self, text):
+        """Run text as more of the program, in the top level environment.
+        
+        Used for sessions that keep one environment over many pieces of 
+        source. Returns the values text left on the top level stack, taking 
+        them off it. If text fails the environment is back at the top level 
+        for the next one, names it bound before failing stay bound."""
+        top, size = self.env, self.env.stack.size
+        try:
+            self.execute(bytecode.compile(parse.parse(text), 
+                                          bytecode.cache.optimize))
+        except BaseException:
+            self.env = top
+            self.live_frames = 1
+            self.arg_len_stack.clear()
+            self.pending = None
+            raise
+        finally:
+            self.flush()
+            values = top.stack.items[top.stack.base+size:]
+            del top.stack.items[top.stack.base+size:]
+        return values
+        
+    def execute(self, program):
+        """Run a Bytecode object to completion in the current environment."""
+        for awaitable in self.steps(program):
+            if awaitable is not None: # a stream of run_async's
+                awaitable.close()
+                raise RuntimeError("Asynchronous streams need run_async")
+                
+    def steps(self, program, budget=None):
+        """Generator running a Bytecode object in the current environment.
+        
+        This is the dispatch loop of the interpreter. It only yields to wait:
+        None after about budget instructions, if budget is given, to let 
+        others run, or an awaitable when an I/O builtin would block (see 
+        call_io). execute and run_async drive it.
+        
+        Each running code body is a frame of (ops, consts, pc, carry, levels),
+        the frames of the callers are kept on a local list while a callee 
+        runs, with the then of the callee if a builtin asked for the call (see
+        call). carry counts the values that tail calls left below the stack of
+        the running body, see tail_env, and levels the calls the frame stands
+        for, one more for each tail call made in it: each of those would have
+        counted the values left at its end toward the enclosing expression, 
+        so the end of the frame counts them that many times.
+        
+        The only jump is a FOLD skipping the instructions it replaced, which 
+        takes them off self.ops right away. So instead of counting every 
+        instruction the number executed is added to self.ops from pc whenever
+        a body is left.
+        The budget is counted down by the length of each body as it is entered
+        (an upper bound of what it runs, bodies have no loops), so checking it
+        costs nothing between calls. The profiler, if there is one, is called
+        on entering and leaving code literals and around builtins.
+        """
+        PUSH, CALL, NEW, EXEC, TCALL, TEXEC, FOLD, BACK = bytecode.PUSH, \
+            bytecode.CALL, bytecode.NEW, bytecode.EXEC, bytecode.TCALL, \
+            bytecode.TEXEC, bytecode.FOLD, bytecode.BACK
+        Reference, Code, LLCode = data.Reference, data.Code, data.LLCode
+        arg_len = self.arg_len_stack
+        profile = self.profiler
+        frames = []
+        ops, consts, pc, carry, levels = program.ops, program.consts, 0, 0, 1
+        left_in_slice = budget
+        try:
+            while True:
+                op = ops[pc]
+                if op == PUSH:
+                    self.env.stack.append(consts[ops[pc+1]])
+                    arg_len[-1] += 1
+                    pc += 2
+                    continue
+                elif op == NEW:
+                    arg_len.append(0)
+                    pc += 2
+                    continue
+                elif op == CALL or op == TCALL:
+                    value = consts[ops[pc+1]]
+                elif op == EXEC or op == TEXEC:
+                    value = self.env.stack.pop()
+                    arg_len[-1] -= 1
+                elif op == FOLD:
+                    fold = consts[ops[pc+1]]
+                    if fold.valid(self): # skip the expression it stands for
+                        self.env.stack.append(fold.value)
+                        if arg_len: # not at the top level of the program
+                            arg_len[-1] += 1
+                        pc += 2 + fold.skip
+                        self.ops -= fold.skip//2
+                    else:
+                        pc += 2
+                    continue
+                elif op == BACK: # end of a body run inline, carry is the
+                                 # count of the expression when it started
+                    self.ops += pc//2 + 1
+                    if profile is not None:
+                        profile.leave(pc//2 + 1)
+                    then = frames[-1][5]
+                    code = None if then is None else then(self, 
+                                                          arg_len[-1] - carry)
+                    if code is None: # the builtin's expression is done
+                        ops, consts, pc, carry, levels, then = frames.pop()
+                        count = arg_len.pop()
+                        if arg_len:
+                            arg_len[-1] += count
+                        continue
+                    if profile is not None:
+                        profile.enter(code, None)
+                    body = code.inlined()
+                    ops, consts, pc, carry = body.ops, body.consts, 0, \
+                                             arg_len[-1]
+                    if budget is not None:
+                        left_in_slice -= len(ops)//2
+                        if left_in_slice <= 0:
+                            left_in_slice = budget
+                            yield None
+                    continue
+                else: # END of a code body
+                    self.ops += pc//2 + 1
+                    if not frames:
+                        return
+                    if profile is not None:
+                        profile.leave(pc//2 + 1)
+                    size = self.env.stack.size
+                    left = size + carry
+                    if arg_len:
+                        arg_len[-1] += left + size*(levels-1)
+                    self.pop_env()
+                    ops, consts, pc, carry, levels, then = frames.pop()
+                    if then is not None:
+                        then(self, left)
+                    continue
+                pc += 2
+            
+                if isinstance(value, Reference):
+                    code = self.search(value)
+                else:
+                    code, value = value, None
+                if isinstance(code, LLCode):
+                    if code.blocking:
+                        yield from self.call_io(code, value)
+                    elif profile is None:
+                        self.call_builtin(code)
+                    else:
+                        profile.builtin(self, code, value)
+                    if self.pending is None:
+                        continue
+                    code, value, then, inline = self.pending # its call
+                    self.pending = None
+                    if inline: # in this frame, the expression stays open
+                        frames.append((ops, consts, pc, carry, levels, then))
+                        if profile is not None:
+                            profile.enter(code, None)
+                        body = code.inlined()
+                        ops, consts, pc, carry = body.ops, body.consts, 0, \
+                                                 arg_len[-1]
+                        if budget is not None:
+                            left_in_slice -= len(ops)//2
+                            if left_in_slice <= 0:
+                                left_in_slice = budget
+                                yield None
+                        continue
+                    self.append_env(value, code)
+                elif isinstance(code, Code):
+                    then = None
+                    # a body run inline calls in tail position only when the
+                    # builtin running it was a tail call running nothing after
+                    # it, frames[level:] are those bodies and their callers
+                    level, body = len(frames), ops
+                    while body[-2] == BACK and level > 1:
+                        caller, _, after, _, _, next_body = frames[level-1]
+                        if next_body is not None or caller[after-2] < TCALL:
+                            break
+                        level, body = level-1, caller
+                    if op >= TCALL and body[-2] != BACK and level:
+                        left = self.tail_env(value)
+                    else:
+                        left = None
+                    if left is not None: # running in this frame now
+                        if level < len(frames): # end the bodies run inline
+                            for frame in reversed(frames[level+1:]):
+                                self.ops += pc//2
+                                if profile is not None:
+                                    profile.leave(pc//2)
+                                pc = frame[2]
+                            self.ops += pc//2
+                            if profile is not None:
+                                profile.leave(pc//2)
+                            for _ in range(len(frames) - level):
+                                count = arg_len.pop() # their expressions
+                                if arg_len:
+                                    arg_len[-1] += count
+                            pc, carry = frames[level][2], frames[level][3]
+                            del frames[level:]
+                        if arg_len: # values left below count at every level
+                            arg_len[-1] += left*(levels-1)
+                        carry, levels = carry + left, levels + 1
+                        self.ops += pc//2
+                        if profile is not None:
+                            profile.tail(code, value, pc//2)
+                        body = code.compiled()
+                        ops, consts, pc = body.ops, body.consts, 0
+                        if budget is not None:
+                            left_in_slice -= len(ops)//2
+                            if left_in_slice <= 0:
+                                left_in_slice = budget
+                                yield None
+                        continue
+                    self.append_env(value)
+                else:
+                    raise TypeError("Cannot execute non-code "+repr(code))
+                frames.append((ops, consts, pc, carry, levels, then))
+                if profile is not None:
+                    profile.enter(code, value)
+                body = code.compiled()
+                ops, consts, pc, carry, levels = body.ops, body.consts, 0, 0, 1
+                if budget is not None:
+                    left_in_slice -= len(ops)//2
+                    if left_in_slice <= 0:
+                        left_in_slice = budget
+                        yield None
+        except BaseException: # count what the unfinished bodies ran
+            self.ops += pc//2 + sum(frame[2] for frame in frames)//2
+            if profile is not None:
+                profile.unwind([frame[2] for frame in frames] + [pc])
+            raise
+                
+    def run_reference(self):
+        """Run the interpreter by walking the parse.Instruction streams.
+        
+        This is the original execution loop, kept as a reference to check the 
+        bytecode loop in execute against."""
         try:
             for op in self:
+                self.ops += 1
                 #print(op)
                 if isinstance(op, parse.Push):
                     self.env.stack.append(op.value)
@@ -32,74 +374,321 @@ class Interpreter:
                     value = self.env.stack.pop()
                     self.arg_len_stack[-1] -= 1
                     
-                    if isinstance(value, data.Code):
+                    if isinstance(value, data.LLCode):
+                        self.call_builtin(value)
+                        if self.pending is not None:
+                            self.push_pending()
+                        
+                    elif isinstance(value, data.Code):
                         self.append_env()
                         self.push(iter(value))
                     
                     elif isinstance(value, data.Reference):
                         code = self.search(value)
-                        assert isinstance(code, data.Code)
                     
                         if isinstance(code, data.LLCode):
-                            code(self)
-                            self.arg_len_stack.pop()
+                            self.call_builtin(code)
+                            if self.pending is not None:
+                                self.push_pending()
                         
-                        else:
+                        elif isinstance(code, data.Code):
                             self.append_env(value)
                             self.push(iter(code))
+                            
+                        else:
+                            raise TypeError("Cannot execute non-code "+
+                                            repr(code))
+                    
+                    else:
+                        raise TypeError("Cannot execute non-code "+repr(value))
                 #print(self.arg_len_stack)
                         
         except Exception as e:
             #print(self.env.stack)
             raise e # need the stack trace for debugging!
             
-    def append_env(self, reference=None):
+    def call_builtin(self, code):
+        """Run an LLCode object on the current expression.
+        
+        Whatever the builtin leaves on the stack stays part of the enclosing 
+        expression, exactly as the leftovers of a code literal do when its 
+        environment is popped."""
+        size = self.env.stack.size
+        code(self)
+        if self.pending is not None: # the expression goes on to a call
+            self.arg_len_stack[-1] += self.env.stack.size - size
+            return
+        count = self.arg_len_stack.pop() + self.env.stack.size - size
+        if self.arg_len_stack:
+            self.arg_len_stack[-1] += count
+            
+    def call_io(self, code, reference=None):
+        """Generator running a builtin that may wait for a stream.
+        
+        Asynchronous streams (streams.AsyncInput, AsyncOutput) raise 
+        streams.Blocked instead of waiting, before changing anything. The 
+        values of the expression are then put back, the awaitable is yielded
+        for run_async to await, and the builtin is run again."""
+        items = self.env.stack.items
+        start = len(items) - self.arg_len_stack[-1]
+        saved = items[start:]
+        while True:
+            try:
+                if self.profiler is None:
+                    self.call_builtin(code)
+                else:
+                    self.profiler.builtin(self, code, reference)
+                return
+            except streams.Blocked as blocked:
+                del items[start:]
+                items.extend(saved)
+                yield blocked.awaitable
+                
+    def call(self, code, reference=None, then=None):
+        """Have the expression of the running builtin call code next.
+        
+        For builtins that run PSIL code. Once the builtin returns, code is 
+        called on the values of the expression, as if it had been executed
+        instead of the builtin (through reference, if not None). If then is 
+        given, then(interpreter, count) is called when code returns, count 
+        being the number of values it left on top of the stack. then must not
+        change the stack."""
+        self.pending = (code, reference, then, False)
+        
+    def inline(self, code, then=None):
+        """Have the running builtin run the body of code next, in this frame.
+        
+        Like call, but no environment is made for code: its body runs in 
+        the environment of the body running the builtin, as if it were 
+        written out in its place, binding names there and leaving its 
+        values on its stack. The values count toward the builtin's 
+        expression, which stays open while the body runs. When the body 
+        ends then(interpreter, count) is called, count being the number of
+        values it left, and may change the stack. then returns the code 
+        literal whose body to run next the same way, or None to end the 
+        builtin's expression. Loops run any number of bodies in one frame 
+        like this, each compiled once (data.Code.inlined)."""
+        self.pending = (code, None, then, True)
+        
+    def push_pending(self):
+        """Start the call a builtin asked for, in the reference loop."""
+        code, reference, then, inline = self.pending
+        self.pending = None
+        if inline:
+            self.inlined[len(self.op_stream_stack)] = \
+                (then, self.arg_len_stack[-1])
+            self.push(iter(code))
+            return
+        self.append_env(reference, code)
+        if then is not None:
+            self.callbacks[len(self.op_stream_stack)] = then
+        self.push(iter(code))
+        
+    def append_env(self, reference=None, target=None):
         """Appends a new environment.
         
         If a reference is given the new environment is appended below the 
         namespace pointed to by that reference, with the search path pointing up
-        through the reference."""
+        through the reference. The namespaces along the reference are put on 
+        the search path as data.Scope objects, they are not modified. target, 
+        if given, takes the place of the namespace the reference ends at.
+        
+        The new environment is a Frame returned earlier if there is one in
+        free_frames (see pop_env), so calls in a loop keep reusing the same
+        few Frame and Stack objects instead of allocating them."""
         stack = self.env.stack # Need to get reference before traversing
         if reference: # set search path
             start = self.search_up(reference)
-            for name in reference:
+            last = len(reference.names) - 1
+            for i, name in enumerate(reference):
                 if start.validate(name):
                     start = start.get(name)
-                    start.parent = self.env
                 else:
                     raise AttributeError("Failed to find "+str(name))
-                self.env = start
+                if i == last and target is not None:
+                    start = target
+                self.env = data.Scope(start, self.env)
         
         # make new namespace
-        self.env = data.Namespace(data.Stack(self.arg_len_stack.pop(),
-                                             stack),
-                                 self.env)
+        size = self.arg_len_stack.pop()
+        if self.free_frames:
+            env = self.free_frames.pop()
+            env.stack.items = stack.items
+            env.stack.base = len(stack.items) - size
+            env.parent = self.env
+            self.frame_hits += 1
+        else:
+            env = data.Frame(data.Stack(size, stack), self.env)
+        self.env = env
+        self.live_frames += 1
+        if self.live_frames > self.peak_frames:
+            self.peak_frames = self.live_frames
+        
+    def tail_env(self, reference=None):
+        """Reuse the current environment for a call in tail position.
+        
+        The current body has nothing left to do, so instead of appending a new 
+        environment the current one is turned into the callee's: its stack 
+        becomes a view of just the arguments and its search path is replaced by
+        the one append_env would have built. Bindings of the finished body stay
+        in the namespace, the callee would have found them up its search path 
+        anyway, and its own bindings shadow them either way.
+        
+        That only holds when no namespace on either search path (the code 
+        literals called through, which are skipped over) has names of its own, 
+        and the environment was never handed out by get. Returns None without 
+        changing anything when it would not be exact, otherwise the number of
+        values of the finished body left below the arguments, which still 
+        count toward the caller's expression when the callee returns."""
+        env = self.env
+        if env.escaped:
+            return None
+        if reference is None: # anonymous code, search path stays the same
+            path = env.parent
+        else:
+            caller = env.parent
+            while caller.stack is None:
+                if caller.dict:
+                    return None
+                caller = caller.parent
+            path = caller
+            start = self.search_up(reference)
+            for name in reference:
+                if start.validate(name):
+                    start = start.get(name)
+                else:
+                    raise AttributeError("Failed to find "+str(name))
+                if start.dict:
+                    return None
+                path = data.Scope(start, path)
+        size = self.arg_len_stack.pop()
+        left = env.stack.size - size
+        env.stack.base = len(env.stack.items) - size # a view of the arguments
+        env.parent = path
+        return left
         
     def pop_env(self):
         """Moves the environment back to the previous execution namespace.
         
         first moves the current env reference up the search path and then
         continues up until it finds an executable environment (one with a stack 
-        reference)."""
-        self.env = self.env.parent
-        while self.env and not self.env.stack:
-            temp = self.env
-            self.env = self.env.parent
-            temp.parent = None
+        reference).
+        
+        The environment left is put in free_frames for append_env to reuse,
+        emptied, unless get handed it out (it lives on as a value then) or 
+        FRAME_POOL frames are waiting already. It gets a new lookups dict, the
+        identity of the old one is what the lookup sites cached results for 
+        this call under (see search)."""
+        frame = self.env
+        env = frame.parent
+        while env is not None and env.stack is None:
+            env = env.parent
+        self.env = env
+        self.live_frames -= 1
+        if not frame.escaped and len(self.free_frames) < FRAME_POOL:
+            frame.parent = None
+            if frame.dict:
+                frame.dict.clear()
+            if frame.lookups:
+                frame.lookups = {}
+            self.free_frames.append(frame)
         
     def search(self, reference):
+        """Dereference reference from the current environment.
+        
+        The result is cached on the reference, a compiled Reference being one 
+        lookup site. The cache is used again from the same environment for as 
+        long as none of the names in the reference were bound or unbound. It 
+        is keyed on the lookups dict of the environment rather than the Frame,
+        which is reused for other calls once this one returns (pop_env)."""
         if reference.last: # verifies reference is not empty
-            return self.search_down(reference, self.search_up(reference))
+            names = reference.names
+            if len(names) == 1:
+                stamp = data.versions.get(reference.first, 0)
+            else:
+                stamp = tuple(data.version(name) for name in names)
+            cache = reference.cache
+            lookups = self.env.lookups
+            if cache is not None and cache[0] is lookups and cache[1] == stamp:
+                return cache[2]
+            found = self.search_down(reference, self.search_up(reference))
+            reference.cache = (lookups, stamp, found)
+            return found
         else:
             return self.env
+            
+    def finds(self, reference, builtin):
+        """Whether reference, a single name, finds builtin from the current
+        environment.
+        
+        What folds and the compiled arithmetic check before using a builtin
+        they did not look up. While nothing anywhere bound the name 
+        (data.version 0) it finds the builtin without a lookup, otherwise it
+        is searched for: a binding of the name in a record, or in another 
+        interpreter of the process, does not shadow the builtin here."""
+        if reference.first not in data.versions:
+            return True
+        try:
+            return self.search(reference) is builtin
+        except (NameError, AttributeError):
+            return False
+        
+    def writable(self, reference):
+        """Dereference reference for binding into what it names.
+        
+        Like search, but shared literals (data.frozen) along the reference 
+        are replaced by copies of their own first, each bound in place of the
+        original, so whatever else holds the original does not see the 
+        binding. Copies of values in a library are bound at the top level 
+        instead. Not cached, every call walks the whole reference."""
+        if not reference.last:
+            return self.env
+        ns = self.search_up(reference)
+        for name in reference:
+            if not ns.validate(name):
+                raise AttributeError(name+" not found in "+str(ns))
+            value = ns.get(name)
+            if data.frozen(value):
+                value = value.copy()
+                if type(ns.dict) is dict:
+                    ns.bind(value, name)
+                elif isinstance(ns, data.Scope): # of a shared literal
+                    raise TypeError("Cannot bind into "+str(reference)+
+                                    ", "+name+" is in a shared value")
+                else: # a library, the copy shadows it from the top level
+                    self.top.bind(value, name)
+            ns = value
+        return ns
         
     def search_up(self, reference):
+        """Find the namespace containing the first name of reference.
+        
+        Execution environments remember where names they looked up were found,
+        so a search passing through the environment of a caller stops there 
+        instead of walking the rest of the path (which grows with recursion).
+        Every environment a search passes through remembers what it found, 
+        searching from there would have found the same, so a name is looked up
+        along a deep path once, not again by each caller it returns to.
+        """
+        name = reference.first
+        version = data.versions.get(name, 0)
         ns = self.env
-        while ns and not ns.validate(reference.first):
+        passed = [] # lookups of the environments walked through
+        while ns is not None and name not in ns.dict:
+            lookups = ns.lookups
+            if lookups is not None:
+                found = lookups.get(name)
+                if found is not None and found[1] == version:
+                    ns = found[0]
+                    break
+                passed.append(lookups)
             ns = ns.parent
         if ns == None:
             raise NameError(str(reference)+" not found.")
         else:
+            found = (ns, version)
+            for lookups in passed:
+                lookups[name] = found
             return ns
     
     def search_down(self, reference, namespace):
@@ -123,23 +712,186 @@ class Interpreter:
                 op = self.op_stream_stack[-1].__next__() # just need one
             except StopIteration:
                 self.op_stream_stack.pop()
+                depth = len(self.op_stream_stack)
+                if depth in self.inlined: # a body run inline ended
+                    then, count = self.inlined.pop(depth)
+                    code = None if then is None else \
+                           then(self, self.arg_len_stack[-1] - count)
+                    if code is None:
+                        count = self.arg_len_stack.pop()
+                        if self.arg_len_stack:
+                            self.arg_len_stack[-1] += count
+                    else:
+                        self.inlined[depth] = (then, self.arg_len_stack[-1])
+                        self.push(iter(code))
+                    continue
+                left = self.env.stack.size
                 if self.arg_len_stack:
-                    self.arg_len_stack[-1] += self.env.stack.size
+                    self.arg_len_stack[-1] += left
                 self.pop_env()
+                then = self.callbacks.pop(len(self.op_stream_stack), None)
+                if then is not None:
+                    then(self, left)
         if op:
             return op
         else: # op_stream_stack is empty
             raise StopIteration()
     
     
+def library(file, parent=None):
+    """Run the program in file and make what it bound at the top level a 
+    library: a read only namespace (data.library) to give to any number of 
+    Interpreters, with parent (default the builtins) as its own parent."""
+    interpreter = Interpreter(file, library=parent)
+    interpreter.run()
+    return data.library(interpreter.top.dict, interpreter.top.parent)
+    
 if __name__ == "__main__":
-    if len(sys.argv) > 1: # sys.argv[0] is the script name
+    parser = argparse.ArgumentParser(description="Run a PSIL program.")
+    parser.add_argument("files", nargs="*", metavar="file",
+                        help="PSIL source file to run, or several with --batch")
+    parser.add_argument("--backend", default="bytecode",
+                        choices=("bytecode", "closures", "reference"),
+                        help="run the program by the bytecode loop, compiled "
+                             "further to Python closures, or by the reference "
+                             "instruction stream loop (default %(default)s)")
+    parser.add_argument("--reference", action="store_true",
+                        help="the same as --backend reference")
+    parser.add_argument("--code-cache", type=int, metavar="N",
+                        default=bytecode.cache.size,
+                        help="number of compiled code literal bodies to keep "
+                             "(default %(default)s)")
+    parser.add_argument("--no-optimize", action="store_true",
+                        help="run the code as written, without folding "
+                             "builtins applied to literals")
+    parser.add_argument("--profile", action="store_true",
+                        help="report calls, instructions and time per code "
+                             "literal and builtin on stderr")
+    parser.add_argument("--profile-sort", choices=sorted(profiler.SORTS),
+                        default="cumulative",
+                        help="order of the profile report (default "
+                             "%(default)s)")
+    parser.add_argument("--profile-limit", type=int, metavar="N",
+                        help="only report the first N rows of the profile")
+    parser.add_argument("--profile-stacks", metavar="FILE",
+                        help="also write the profile as collapsed stacks, as "
+                             "read by flamegraph tools, to FILE")
+    parser.add_argument("--serve", action="store_true",
+                        help="run a server that keeps the interpreter loaded "
+                             "and runs programs sent to --socket")
+    parser.add_argument("--connect", action="store_true",
+                        help="run file, or the interactive mode, on the "
+                             "server at --socket")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="Unix socket of the server (default in the "
+                             "temporary directory)")
+    parser.add_argument("--session", default="default",
+                        help="server session used by the interactive mode "
+                             "(default %(default)s)")
+    parser.add_argument("--batch", action="store_true",
+                        help="run every file (and those in --manifest) in its "
+                             "own interpreter on a pool of processes")
+    parser.add_argument("--manifest", metavar="FILE", action="append",
+                        default=[],
+                        help="file listing programs to run, one a line")
+    parser.add_argument("--jobs", type=int, metavar="N",
+                        help="worker processes of --batch (default one per "
+                             "processor)")
+    parser.add_argument("--threads", action="store_true",
+                        help="run --batch programs on threads of this process "
+                             "instead of worker processes")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="stop --batch programs running longer than this")
+    parser.add_argument("--image", metavar="FILE",
+                        help="start with the names saved in the image FILE "
+                             "defined (see --save-image)")
+    parser.add_argument("--save-image", metavar="FILE",
+                        help="after running file, save the names it defined "
+                             "and their compiled code as an image in FILE")
+    parser.add_argument("--prefix", default=">_< ",
+                        help="start of every line printed by out (default "
+                             "'%(default)s', '' for none)")
+    parser.add_argument("--buffer", type=int, metavar="N", 
+                        default=streams.BUFFER_SIZE,
+                        help="characters of output buffered before writing "
+                             "(default %(default)s, 0 writes every line)")
+    parser.add_argument("--error-buffer", type=int, metavar="N", default=0,
+                        help="the same for stderr (default %(default)s)")
+    args = parser.parse_args()
+    if args.manifest and not args.batch:
+        parser.error("--manifest needs --batch")
+    if args.threads and (args.timeout or not args.batch):
+        parser.error("--threads needs --batch and can not time programs out")
+    if len(args.files) > 1 and not args.batch:
+        parser.error("more than one file needs --batch")
+    args.file = args.files[0] if args.files and not args.batch else None
+    args.reference = args.reference or args.backend == "reference"
+    if (args.reference or args.backend == "closures") and \
+       (args.profile or args.profile_stacks):
+        parser.error("the profiler only works with the bytecode interpreter")
+    if args.save_image and not args.file:
+        parser.error("--save-image needs a file to run")
+    if args.code_cache < 0:
+        parser.error("--code-cache can not be negative")
+    bytecode.cache.resize(args.code_cache)
+    bytecode.cache.set_optimize(not args.no_optimize)
+    if args.batch:
+        import batch
+        paths = list(args.files)
+        for name in args.manifest:
+            paths += batch.manifest(name)
+        sys.exit(1 if batch.main(paths, args.jobs, args.timeout, 
+                                 threads=args.threads, image=args.image) 
+                 else 0)
+    if args.serve or args.connect or not args.file:
+        import server # imports this module, only needed from here
+        path = args.socket or server.SOCKET
+    if args.serve:
+        server.serve(path)
+    elif args.connect and args.file:
+        with open(args.file, "r") as f:
+            source = parse.read(f)
+        client = server.Client(path)
+        response = client.run(source)
+        client.close()
+        server.show(response)
+        if response["error"] is not None:
+            sys.exit(1)
+    elif args.file:
+        if args.image or args.save_image:
+            import image
+        with open(args.file, "r") as f:
+            interpreter = Interpreter(f, reference=args.reference, 
+                                      prefix=args.prefix, 
+                                      buffering=args.buffer,
+                                      error_buffering=args.error_buffer,
+                                      library=args.image and 
+                                              image.load(args.image),
+                                      closures=args.backend == "closures")
+        if args.profile or args.profile_stacks:
+            interpreter.profiler = profiler.Profiler(interpreter.source, 
+                                                     args.file)
         try:
-            f = open(sys.argv[1], "r")
-            interpreter = Interpreter(f)
             interpreter.run()
         finally:
-            f.close()
-    else:
-        print("Need to implement an interactive mode!")
+            if args.profile:
+                print(interpreter.profiler.report(args.profile_sort, 
+                                                  args.profile_limit),
+                      file=sys.stderr)
+            if args.profile_stacks:
+                with open(args.profile_stacks, "w") as out:
+                    interpreter.profiler.collapsed(out)
+        if args.save_image:
+            image.save(interpreter, args.save_image)
+    else: # interactive mode, on the server if there is one
+        try:
+            client = server.Client(path)
+        except OSError:
+            if args.connect:
+                raise
+            client = server.Local()
+        try:
+            server.repl(client, args.session)
+        finally:
+            client.close()
     
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""Long running PSIL interpreter, serving programs over a local Unix socket.
+
+For small programs, starting Python, importing the interpreter and parsing the
+code literal bodies costs more than running them. The server does that once
+and stays up with its builtins and bytecode.cache warm: clients send source
+over the socket and get back what it printed. A program runs either on its
+own, in a fresh environment, or in a named session whose environment lives as
+long as the server does, so names defined by one request are there for the
+next.
+
+Requests and responses are JSON objects, one per line:
+    {"op": "run", "source": text}
+    {"op": "eval", "source": text, "session": name}
+    {"op": "reset", "session": name}
+    {"op": "stats"}
+    {"op": "stop"}
+each answered by {"output": text, "values": [text], "error": text or null},
+values being what eval left on the session's top level stack."""
+
+import contextlib, io, json, os, socket, socketserver, sys, tempfile, threading
+
+import bytecode, parse, psil, streams
+
+SOCKET = os.path.join(tempfile.gettempdir(),
+                      "psil-{}.sock".format(os.getuid()))
+
+class Session:
+    """A top level environment kept between requests.
+    
+    Requests to one session run one at a time, each with its output going to
+    its own stream."""
+    def __init__(self):
+        self.interpreter = psil.Interpreter(io.StringIO(""))
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def evaluate(self, text, output):
+        with self.lock:
+            self.requests += 1
+            interpreter = self.interpreter
+            interpreter.stdout = streams.Output(output, interpreter.buffering)
+            return interpreter.evaluate(text)
+
+def respond(request, sessions, lock=None):
+    """Carry out one request, sessions maps session names to Sessions.
+
+    Everything the program prints is captured into the response, errors in
+    the program are reported in it instead of being raised. Requests can be
+    answered in many threads at once, lock (if given) guards sessions."""
+    op = request.get("op")
+    source = request.get("source", "")
+    name = request.get("session", "default")
+    output = io.StringIO()
+    values = []
+    error = None
+    lock = lock or contextlib.nullcontext()
+    try:
+        if op == "run":
+            psil.Interpreter(io.StringIO(source), output=output).run()
+        elif op == "eval":
+            with lock:
+                if name not in sessions:
+                    sessions[name] = Session()
+                session = sessions[name]
+            values = [str(value) for value in session.evaluate(source, 
+                                                               output)]
+        elif op == "reset":
+            with lock:
+                sessions.pop(name, None)
+        elif op == "stats":
+            output.write(str(bytecode.cache)+"\n")
+            with lock:
+                listed = sorted(sessions.items())
+            for key, session in listed:
+                interpreter = session.interpreter
+                output.write("session {}: {} requests, {} instructions, "
+                             "{} frames reused, {} at most\n"
+                             .format(key, session.requests, interpreter.ops,
+                                     interpreter.frame_hits,
+                                     interpreter.peak_frames))
+        else:
+            raise ValueError("Unknown request "+repr(op))
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    return {"output": output.getvalue(), "values": values, "error": error}
+
+class Handler(socketserver.StreamRequestHandler):
+    """Answers the requests of one connection until the client closes it."""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"output": "", "values": [],
+                            "error": "ValueError: bad request, "+str(e)}
+            else:
+                response = self.server.respond(request)
+            self.wfile.write(json.dumps(response).encode()+b"\n")
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves requests from any number of connections.
+
+    Each connection has a thread, requests of different connections run at 
+    the same time, each in its own Interpreter or in its session's."""
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET):
+        if os.path.exists(path):
+            try: # is there a live server on it?
+                Client(path).close()
+            except OSError: # left over from a server that died
+                os.unlink(path)
+            else:
+                raise OSError("A server is already running on "+path)
+        super().__init__(path, Handler)
+        self.path = path
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def respond(self, request):
+        if request.get("op") == "stop":
+            # shutdown waits for serve_forever, which waits for this request
+            threading.Thread(target=self.shutdown).start()
+            return {"output": "", "values": [], "error": None}
+        return respond(request, self.sessions, self.lock)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def serve(path=SOCKET):
+    """Run a server on path until it is sent a stop request."""
+    server = Server(path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class Client:
+    """Connection to a server."""
+    def __init__(self, path=SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, op, **fields):
+        fields["op"] = op
+        self.file.write(json.dumps(fields).encode()+b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        return json.loads(line)
+
+    def run(self, source):
+        return self.request("run", source=source)
+
+    def evaluate(self, source, session="default"):
+        return self.request("eval", source=source, session=session)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+class Local:
+    """Stands in for a Client when there is no server, running in process."""
+    def __init__(self):
+        self.sessions = {}
+
+    def request(self, op, **fields):
+        fields["op"] = op
+        return respond(fields, self.sessions)
+
+    def evaluate(self, source, session="default"):
+        return self.request("eval", source=source, session=session)
+
+    def close(self):
+        pass
+
+def complete(text):
+    """Whether text is whole, or is missing a closing ), }, quote or #."""
+    depth = 0
+    try:
+        for token in parse.tokenize(text):
+            if isinstance(token, parse.StartExpression):
+                depth += 1
+            elif isinstance(token, parse.EndExpression):
+                depth -= 1
+    except SyntaxError as e:
+        return not str(e).startswith(("Unclosed comment",
+                                      "Reached end of source"))
+    return depth <= 0
+
+def show(response, out=None, err=None):
+    """Print a response the way running the program locally would have."""
+    out = out or sys.stdout
+    err = err or sys.stderr
+    out.write(response["output"])
+    for value in response["values"]:
+        out.write("=> "+value+"\n")
+    if response["error"] is not None:
+        err.write(response["error"]+"\n")
+
+def repl(client, session="default"):
+    """Read PSIL from the terminal and evaluate it in session until EOF.
+
+    Input is read until the parentheses and braces it opened are closed, so
+    one entry can span lines. What it leaves on the stack is shown after its
+    output."""
+    try:
+        import readline # line editing and history, where available
+    except ImportError:
+        pass
+    print("PSIL, end with Ctrl-D")
+    while True:
+        try:
+            text = input("psil> ")
+            while not complete(text):
+                text += "\n"+input("....> ")
+        except EOFError:
+            print()
+            return
+        except KeyboardInterrupt:
+            print()
+            continue
+        if text.strip():
+            show(client.evaluate(text, session))
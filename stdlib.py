@@ -1,7 +1,12 @@
 """Builtin functions for PSIL"""
 
-from data import LLCode, Numeric, Reference
+import operator, threading
+from collections import OrderedDict
+
+from data import Code, Handle, LLCode, Numeric, Reference, Sequence, String, \
+                 Vector, boolean, freeze, library, number
 from parse import Token
+import streams
 
 def pop(state):
     """Got tired of writing "state.env.stack" """
@@ -14,39 +19,329 @@ def push(state, val):
 class Duplicate(LLCode):
     """Duplicate the top item on the stack.
     
-    actually copies objects, but references are themselves copied, so 
-    duplicating a reference and then manipulating the object the reference is 
-    pointing to changes the object the second reference is pointed to as 
-    well."""
+    Pushes the same object again, literals are copied on write (see 
+    data.Literal), so the two behave as copies. A reference is duplicated as
+    a reference, manipulating the object it points to through one changes 
+    the object the other one points to as well."""
+    effect = (1, 2)
+    
     def __call__(self, state):
-        val = state.env.stack.peek()
-        new = (type(val))(val)
-        push(state, new)
+        push(state, freeze(state.env.stack.peek()))
         
 class Swap(LLCode):
     """Swaps the two items on the top of the stack."""
+    effect = (2, 2)
+    
     def __call__(self, state):
         top, under = pop(state), pop(state)
         push(state, top)
         push(state, under)
         
+def stream(state, handle, kind=None):
+    """The stream behind a Handle from the stack, checked to be a kind."""
+    if isinstance(handle, Reference):
+        handle = state.search(handle)
+    if not isinstance(handle, Handle):
+        raise TypeError(str(handle)+" is not a file handle")
+    if handle.stream is None: # one of the interpreter's own
+        found = getattr(state, handle.name)
+    else:
+        found = handle.stream
+    if kind is not None and not isinstance(found, kind):
+        raise TypeError(str(handle)+" is not open for "+
+                        ("reading" if kind is streams.Input else "writing"))
+    return found
+    
+def count(state, val):
+    """A non-negative whole number from the stack."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Numeric) or val.val != int(val.val) or val.val < 0:
+        raise TypeError(str(val)+" is not a count")
+    return int(val.val)
+    
+def line(text):
+    """What reading a line gives PSIL code: a String, empty for an empty 
+    line, or False at the end (None)."""
+    if text is None:
+        return number(0)
+    return String(text)
+    
 class Out(LLCode):
-    """Sends top item on stack to stdout.
+    """Sends top item on stack to stdout, on a line of its own.
+    
+    The line starts with the interpreter's prefix (">_< " unless it was given 
+    another one)."""
+    effect = (1, 0)
+    blocking = True
+    
+    def __call__(self, state):
+        state.stdout.write(state.prefix+str(pop(state))+"\n")
+        
+class Err(LLCode):
+    """Sends top item on stack to stderr, on a line of its own.
+    
+    Flushes stdout first, so the two stay in order on a terminal."""
+    effect = (1, 0)
+    
+    def __call__(self, state):
+        state.stdout.flush()
+        state.stderr.write(str(pop(state))+"\n")
+        
+class In(LLCode):
+    """Read a line from stdin, pushing False at the end of the input."""
+    effect = (0, 1)
+    blocking = True
+    
+    def __call__(self, state):
+        state.stdout.flush() # whatever asked for the input
+        push(state, line(state.stdin.readline()))
+        
+class Open(LLCode):
+    """Open the file named by the second item with the mode on top.
+    
+    Modes are "r", "w" and "a". Pushes a handle, output to it is buffered like
+    stdout is."""
+    def __call__(self, state):
+        mode = str(pop(state))
+        path = pop(state)
+        if isinstance(path, Reference):
+            path = state.search(path)
+        if mode == "r":
+            handle = Handle(streams.open_input(str(path)))
+        else:
+            handle = Handle(streams.open_output(str(path), mode, 
+                                                state.buffering))
+        state.handles.append(handle.stream)
+        push(state, handle)
+        
+class Write(LLCode):
+    """Write the top item to the handle below it, without a line break."""
+    blocking = True
+    
+    def __call__(self, state):
+        val = pop(state)
+        stream(state, pop(state), streams.Output).write(str(val))
+        
+class ReadLine(LLCode):
+    """Read a line from the handle on top, False at the end of its input.
+    
+    The line break is not part of the line, an empty line is an empty 
+    String."""
+    blocking = True
+    
+    def __call__(self, state):
+        push(state, line(stream(state, pop(state), streams.Input).readline()))
+        
+class ReadLines(LLCode):
+    """Read as many lines as the top item says from the handle below it.
+    
+    Pushes them as a Sequence, which is shorter than asked for (empty) at the
+    end of the input. Reading many lines in one call saves running code for 
+    each of them."""
+    blocking = True
     
-    "Proper" I/O will be handled later."""
     def __call__(self, state):
-        print(">_< "+str(pop(state)))
+        size = count(state, pop(state))
+        lines = stream(state, pop(state), streams.Input).readlines(size)
+        push(state, Sequence(String(text) for text in lines))
+        
+class Read(LLCode):
+    """Read as many characters as the top item says from the handle below it.
+    
+    Pushes fewer at the end of the input, False after it."""
+    blocking = True
+    
+    def __call__(self, state):
+        size = count(state, pop(state))
+        text = stream(state, pop(state), streams.Input).read(size)
+        push(state, String(text) if text else number(0))
+        
+class Length(LLCode):
+    """Push the number of items in a Sequence or Vector, or characters in a 
+    String."""
+    effect = (1, 1)
+    
+    def __call__(self, state):
+        val = pop(state)
+        if isinstance(val, Reference):
+            val = state.search(val)
+        if isinstance(val, (Sequence, Vector)):
+            push(state, number(len(val)))
+        elif isinstance(val, String):
+            push(state, number(len(val.string)))
+        else:
+            raise TypeError(str(val)+" has no length")
+            
+class Item(LLCode):
+    """Push the item of the Sequence or Vector below the top at the index on
+    top.
+    
+    Indexes count from 0, negative ones from the end."""
+    effect = (2, 1)
+    
+    def __call__(self, state):
+        at = index(state, pop(state))
+        seq = pop(state)
+        if isinstance(seq, Reference):
+            seq = state.search(seq)
+        if isinstance(seq, Vector):
+            push(state, seq.item(at))
+        elif isinstance(seq, Sequence):
+            push(state, seq.items[at])
+        else:
+            raise TypeError(str(seq)+" is not a Sequence")
+        
+def vector(state, val):
+    """The Vector a value from the stack is or names."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Vector):
+        raise TypeError(str(val)+" is not a Vector")
+    return val
+    
+def index(state, val):
+    """A whole number from the stack, used as an index."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Numeric) or val.val != int(val.val):
+        raise TypeError(str(val)+" is not an index")
+    return int(val.val)
+    
+def numeric(val):
+    """The Python number a Numeric is, or a String holds."""
+    if isinstance(val, Numeric):
+        return val.val
+    if isinstance(val, String):
+        text = val.string.strip()
+        return float(text) if "." in text or "e" in text.lower() else \
+               int(text)
+    raise TypeError(str(val)+" is not a number")
+    
+class MakeVector(LLCode):
+    """Push a Vector of the values of the expression.
+    
+    Strings holding numbers are read as the number, so (lines vector) works on
+    what readlines gave. A single Sequence or Vector gives one of its items."""
+    def __call__(self, state):
+        items = state.env.stack.items
+        start = len(items) - state.arg_len_stack[-1]
+        values = [state.search(val) if isinstance(val, Reference) else val 
+                  for val in items[start:]]
+        del items[start:]
+        if len(values) == 1 and isinstance(values[0], Vector):
+            push(state, Vector(values[0]))
+            return
+        if len(values) == 1 and isinstance(values[0], Sequence):
+            values = values[0].items
+        push(state, Vector([numeric(val) for val in values]))
+        
+class Range(LLCode):
+    """Push the Vector of the integers from the number below the top up to, 
+    not including, the top. With only one number they start from 0."""
+    def __call__(self, state):
+        end = index(state, pop(state))
+        start = 0
+        if state.arg_len_stack[-1] > 1:
+            start = index(state, pop(state))
+        push(state, Vector(range(start, end)))
+        
+class Sum(LLCode):
+    """Push the sum of the items of the Vector on top."""
+    def __call__(self, state):
+        push(state, vector(state, pop(state)).sum())
+        
+class Minimum(LLCode):
+    """Push the smallest item of the Vector on top."""
+    def __call__(self, state):
+        push(state, vector(state, pop(state)).min())
+        
+class Maximum(LLCode):
+    """Push the largest item of the Vector on top."""
+    def __call__(self, state):
+        push(state, vector(state, pop(state)).max())
+        
+class Dot(LLCode):
+    """Push the dot product of the top two Vectors."""
+    def __call__(self, state):
+        v2 = vector(state, pop(state))
+        push(state, vector(state, pop(state)).dot(v2))
+        
+class Slice(LLCode):
+    """Push the items of a Vector from one index up to another: (v 2 5 slice)
+    
+    Indexes count from 0, negative ones from the end."""
+    def __call__(self, state):
+        end = index(state, pop(state))
+        start = index(state, pop(state))
+        push(state, vector(state, pop(state)).slice(start, end))
+        
+class Map(LLCode):
+    """Do a math builtin on each item of a Vector: (v 2 mul map)
+    
+    The top is the builtin (add, sub, mul, div, mod or a comparison), below it
+    the other operand, a number or a Vector as long as the first, which is
+    below that. Comparisons give Vectors of 1s and 0s."""
+    def __call__(self, state):
+        op = pop(state)
+        if isinstance(op, Reference):
+            op = state.search(op)
+        if not isinstance(op, Math):
+            raise TypeError("Can only map math builtins, not "+str(op))
+        other = pop(state)
+        if isinstance(other, Reference):
+            other = state.search(other)
+        push(state, vector(state, pop(state)).combine(op.function, other))
+        
+class Flush(LLCode):
+    """Write out what is buffered for the handle on top."""
+    def __call__(self, state):
+        stream(state, pop(state)).flush()
+        
+class Close(LLCode):
+    """Flush and close the handle on top."""
+    def __call__(self, state):
+        opened = stream(state, pop(state))
+        opened.close()
+        if opened in state.handles:
+            state.handles.remove(opened)
         
 class Get(LLCode):
     """Dereference a Reference."""
+    effect = (1, 1)
+    
     def __call__(self, state):
         ref = pop(state)
         assert isinstance(ref, Reference)
-        push(state, state.search(ref))
+        ns = state.search(ref)
+        if ns is state.env: # the environment is now reachable as a value
+            ns.escaped = True
+        push(state, freeze(ns))
         
 class Math(LLCode):
-    """Superclass for math operations with useful helper functions."""
-    def binary(self, state):
+    """Superclass for math operations with useful helper functions.
+    
+    function is the Python operator doing the operation, map uses it to do 
+    the operation on each item of a Vector."""
+    function = None
+    pure = True
+    effect = (2, 1)
+    
+    def fold(self, values):
+        """The result on two numbers, operations failing are left to fail 
+        when the code runs."""
+        if len(values) != 2 or not isinstance(values[0], Numeric) or \
+           not isinstance(values[1], Numeric):
+            return None
+        try:
+            result = self.function(values[0].val, values[1].val)
+        except ArithmeticError:
+            return None
+        if isinstance(result, bool):
+            return boolean(result)
+        return number(result)
+        
+    def operands(self, state):
         """pull two items off and return them in the correct order."""
         val2 = pop(state)
         val1 = pop(state)
@@ -55,43 +350,385 @@ class Math(LLCode):
             val1 = state.search(val1)
         if isinstance(val2, Reference):
             val2 = state.search(val2)
-            
-        if isinstance(val1, Numeric) and isinstance(val2, Numeric):
+        return (val1, val2)
+        
+    def binary(self, state):
+        """pull two numbers off and return them in the correct order.
+        
+        Either can be a Vector, the arithmetic operations then work on each 
+        of its items."""
+        val1, val2 = self.operands(state)
+        if isinstance(val1, (Numeric, Vector)) and \
+           isinstance(val2, (Numeric, Vector)):
             return (val1, val2)
         else:
             raise TypeError("Tried to math non-numerics")
         
+class Add(Math):
+    """Add the top two items from the stack"""
+    function = operator.add
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, v1+v2)
         
 class Multiply(Math):
     """Multiply the top two items from the stack"""
+    function = operator.mul
+    
     def __call__(self, state):
         v1, v2 = self.binary(state)
         push(state, v1*v2)
         
 class Subtract(Math):
     """subtract the second item on the stack by the top"""
+    function = operator.sub
+    
     def __call__(self, state):
         v1, v2 = self.binary(state)
         push(state, v1-v2)
+        
+class Divide(Math):
+    """divide the second item on the stack by the top"""
+    function = operator.truediv
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, v1/v2)
+        
+class Modulo(Math):
+    """remainder of the second item on the stack divided by the top"""
+    function = operator.mod
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, v1%v2)
+        
+class Less(Math):
+    """True if the second item on the stack is less than the top"""
+    function = operator.lt
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, boolean(v1 < v2))
+        
+class Greater(Math):
+    """True if the second item on the stack is greater than the top"""
+    function = operator.gt
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, boolean(v1 > v2))
+        
+class LessEqual(Math):
+    """True if the second item on the stack is at most the top"""
+    function = operator.le
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, boolean(v1 <= v2))
+        
+class GreaterEqual(Math):
+    """True if the second item on the stack is at least the top"""
+    function = operator.ge
+    
+    def __call__(self, state):
+        v1, v2 = self.binary(state)
+        push(state, boolean(v1 >= v2))
+        
+class Equal(Math):
+    """True if the top two items are equal.
     
+    Numbers compare by value (1 and 1.0 are equal), strings by their text, 
+    anything else only equals itself."""
+    function = operator.eq
+    
+    def __call__(self, state):
+        v1, v2 = self.operands(state)
+        if isinstance(v1, Numeric) and isinstance(v2, Numeric):
+            push(state, boolean(v1.val == v2.val))
+        elif isinstance(v1, String) and isinstance(v2, String):
+            push(state, boolean(v1.string == v2.string))
+        else:
+            push(state, boolean(v1 is v2))
+    
+MEMO_SIZE = 1024 # results a memo keeps by default
+
+def memo_key(state, val):
+    """What identifies an argument value to a Memo.
+    
+    Numbers and strings by value, references by the value they name (by their
+    text if they name nothing yet), anything else by identity."""
+    if isinstance(val, Reference):
+        try:
+            val = state.search(val)
+        except (NameError, AttributeError):
+            return ("Reference", val.string)
+    if isinstance(val, Numeric):
+        return (type(val).__name__, val.val)
+    if isinstance(val, String):
+        return ("String", val.string)
+    return val
+    
+class Memo(LLCode):
+    """A code literal that remembers its results.
+    
+    Running it looks up the values of the expression it is run on. If code was
+    run on equal values before, the values it left then are pushed again, 
+    otherwise code is called and what it leaves is kept. At most size results 
+    are kept, the least recently used one goes first. Only worth it for code 
+    whose results depend on nothing but its arguments."""
+    def __init__(self, code, reference=None, size=MEMO_SIZE):
+        super().__init__()
+        if isinstance(code, Memo): # copies share the results
+            self.__dict__.update(code.__dict__)
+            return
+        self.code = code
+        self.reference = reference
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # a memo in a library is shared
+        
+    def __call__(self, state):
+        items = state.env.stack.items
+        start = len(items) - state.arg_len_stack[-1]
+        key = tuple(memo_key(state, val) for val in items[start:])
+        with self.lock:
+            found = self.results.get(key)
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results.move_to_end(key)
+        if found is None:
+            state.call(self.code, self.reference, 
+                       lambda state, count: self.keep(key, state, count))
+        else:
+            del items[start:]
+            items.extend(found)
+            
+    def keep(self, key, state, count):
+        items = state.env.stack.items
+        with self.lock:
+            self.results[key] = tuple(freeze(val) for val in 
+                                      items[len(items)-count:])
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+            
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hits = self.misses = 0
+            
+    def __getstate__(self): # for images, see image.py
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+        
+    def __setstate__(self, state):
+        super().__init__()
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        
+    def __repr__(self):
+        return "PSIL Memo: "+repr(self.code)
+        
+def memo(state, val):
+    """The Memo a value from the stack is or names."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Memo):
+        raise TypeError(str(val)+" is not a memo")
+    return val
+    
+class MakeMemo(LLCode):
+    """Wrap the code literal on top, or named on top, in a Memo.
+    
+    With a number below it, that is the most results the memo keeps."""
+    def __call__(self, state):
+        target = pop(state)
+        size = MEMO_SIZE
+        if state.arg_len_stack[-1] > 1:
+            size = count(state, pop(state))
+        reference = None
+        if isinstance(target, Reference):
+            reference, target = target, state.search(target)
+        if isinstance(target, Memo) or not isinstance(target, Code) or \
+           isinstance(target, LLCode):
+            raise TypeError("Can only memo code literals, not "+str(target))
+        push(state, Memo(target, reference, size))
+        
+class MemoClear(LLCode):
+    """Forget the results kept by the memo on top, and its statistics."""
+    def __call__(self, state):
+        memo(state, pop(state)).clear()
+        
+class MemoStats(LLCode):
+    """Push hits, misses, results kept and most kept of the memo on top."""
+    def __call__(self, state):
+        found = memo(state, pop(state))
+        push(state, Sequence(number(n) for n in (found.hits, found.misses, 
+                                                 len(found.results), 
+                                                 found.size)))
+        
+def body(state, val):
+    """The code literal a value from the stack is or names, to run inline."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Code) or isinstance(val, LLCode):
+        raise TypeError(str(val)+" is not a code literal")
+    return val
+    
+def truth(state, val):
+    """Whether a condition from the stack holds: a number other than 0."""
+    if isinstance(val, Reference):
+        val = state.search(val)
+    if not isinstance(val, Numeric):
+        raise TypeError("Condition "+str(val)+" is not a number")
+    return val.val != 0
+    
+class If(LLCode):
+    """Run one of two code literals: (cond {then} {else} if)
+    
+    The else literal can be left out. The literal runs in the current frame
+    (see Interpreter.inline), names it binds stay bound after it, the values
+    it leaves count as the values of the if expression."""
+    def __call__(self, state):
+        otherwise = None
+        if state.arg_len_stack[-1] > 2:
+            otherwise = body(state, pop(state))
+        then = body(state, pop(state))
+        if truth(state, pop(state)):
+            state.inline(then)
+        elif otherwise is not None:
+            state.inline(otherwise)
+            
+class While(LLCode):
+    """Run a code literal as long as another one leaves a true value:
+    ({cond} {body} while)
+    
+    cond runs first, the value it leaves on top is taken off the stack and
+    checked, then body runs and cond again, until that value is 0. Both run 
+    in the current frame, one loop takes no frame or stack of its own however
+    long it runs. Values left by body count as the values of the while 
+    expression."""
+    def __call__(self, state):
+        code = body(state, pop(state))
+        loop = Loop(body(state, pop(state)), code)
+        state.inline(loop.cond, loop.next)
+        
+class Loop:
+    """The state of one running while."""
+    def __init__(self, cond, body):
+        self.cond = cond
+        self.body = body
+        self.checking = True # cond is running, not body
+        
+    def next(self, state, count):
+        """Code to run after cond or body left count values, None to stop."""
+        if not self.checking:
+            self.checking = True
+            return self.cond
+        if not count:
+            raise ValueError("while condition left no value")
+        state.arg_len_stack[-1] -= 1
+        if truth(state, pop(state)):
+            self.checking = False
+            return self.body
+        return None
+        
+class Times(LLCode):
+    """Run a code literal a number of times: (n {body} times)
+    
+    body runs in the current frame, as for while."""
+    def __call__(self, state):
+        code = body(state, pop(state))
+        left = count(state, pop(state))
+        if left:
+            state.inline(code, Counter(code, left).next)
+            
+class Counter:
+    """The state of one running times."""
+    def __init__(self, code, left):
+        self.code = code
+        self.left = left
+        
+    def next(self, state, count):
+        self.left -= 1
+        return self.code if self.left else None
+        
 class Bind(LLCode):
-    """Pull a value and a name off the stack and bind them in the namespace."""
+    """Pull a value and a name off the stack and bind them in the namespace.
+    
+    Shared literals on the way to the namespace are copied first, see 
+    Interpreter.writable."""
+    effect = (2, 0)
+    
     def __call__(self, state):
         val = pop(state)
         name = pop(state)
-        ns = state.search(name.previous())
-        ns.bind(val, name.last)
+        state.writable(name.previous()).bind(val, name.last)
         
 builtins = {
     "def" : Bind(),
     "get" : Get(),
     
+    "memo": MakeMemo(),
+    "memoclear": MemoClear(),
+    "memostats": MemoStats(),
+    
     "dup" : Duplicate(),
     "swap": Swap(),
     
+    "if"  : If(),
+    "while": While(),
+    "times": Times(),
+    
+    "in"  : In(),
     "out" : Out(),
+    "err" : Err(),
+    "open": Open(),
+    "write": Write(),
+    "flush": Flush(),
+    "close": Close(),
+    "readline": ReadLine(),
+    "readlines": ReadLines(),
+    "read": Read(),
+    "stdin": Handle(None, "stdin"),
+    "stdout": Handle(None, "stdout"),
+    "stderr": Handle(None, "stderr"),
     
+    "add" : Add(),
     "sub" : Subtract(),
-    "mul" : Multiply()
+    "mul" : Multiply(),
+    "div" : Divide(),
+    "mod" : Modulo(),
+    
+    "eq"  : Equal(),
+    "lt"  : Less(),
+    "gt"  : Greater(),
+    "le"  : LessEqual(),
+    "ge"  : GreaterEqual(),
     
-    }
\ No newline at end of file
+    "True" : number(1),
+    "False": number(0),
+    
+    "length": Length(),
+    "item": Item(),
+    
+    "vector": MakeVector(),
+    "range": Range(),
+    "sum" : Sum(),
+    "min" : Minimum(),
+    "max" : Maximum(),
+    "dot" : Dot(),
+    "slice": Slice(),
+    "map" : Map()
+    
+    }
+
+## The builtins as the read only namespace every interpreter's top level 
+## environment has as its parent, shared by all of them.
+namespace = library(builtins)
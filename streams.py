@@ -0,0 +1,222 @@
+"""Input and output streams of a running PSIL program.
+
+The builtins doing I/O never touch Python files themselves. They go through
+the streams of the interpreter (state.stdin, state.stdout, state.stderr) or of
+a data.Handle. Output streams collect what is written and pass it on in few,
+large writes, input streams read lazily, never more than was asked for, so a
+program can work through input of any size.
+
+The asynchronous streams work on asyncio streams for Interpreter.run_async. 
+They never wait: when they can not do what was asked right away they raise
+Blocked, the interpreter awaits what it carries and asks again."""
+
+import codecs, sys
+
+BUFFER_SIZE = 1<<16 # characters collected before they are written out
+
+class Blocked(Exception):
+    """An asynchronous stream can not go on without waiting.
+    
+    Raised before the stream changed anything, awaitable is what to wait for 
+    before trying again."""
+    def __init__(self, awaitable):
+        super().__init__("Stream would block")
+        self.awaitable = awaitable
+
+class Output:
+    """Buffered text output.
+
+    file is a file object, or the name of one in sys ("stdout", "stderr"),
+    which is looked up whenever the buffer is written out, so output follows
+    redirections of sys.stdout made after the stream was created. Text waits
+    in the buffer until size characters are there, or flush is called. A size
+    of 0 writes everything straight through."""
+    def __init__(self, file="stdout", size=BUFFER_SIZE, name=None):
+        self.file = file
+        self.size = size
+        self.name = name or (file if isinstance(file, str) else
+                             getattr(file, "name", "<file>"))
+        self.parts = []
+        self.pending = 0
+        self.closed = False
+
+    def target(self):
+        if isinstance(self.file, str):
+            return getattr(sys, self.file)
+        return self.file
+
+    def write(self, text):
+        if self.closed:
+            raise ValueError("Write to closed stream "+str(self.name))
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffer and flush the file."""
+        if self.parts:
+            file = self.target()
+            file.write("".join(self.parts))
+            self.parts.clear()
+            self.pending = 0
+            file.flush()
+
+    def close(self):
+        """Flush, and close the file unless it is one of sys's."""
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            if not isinstance(self.file, str):
+                self.file.close()
+
+class Input:
+    """Lazily read text input.
+
+    file is a file object or the name of one in sys, as for Output. Lines 
+    come from a generator reading one line at a time from the file, chunks
+    are read directly, the two can be mixed."""
+    def __init__(self, file="stdin", name=None):
+        self.file = file
+        self.name = name or (file if isinstance(file, str) else
+                             getattr(file, "name", "<file>"))
+        self.source = self.lines()
+        self.closed = False
+
+    def target(self):
+        if self.closed:
+            raise ValueError("Read from closed stream "+str(self.name))
+        if isinstance(self.file, str):
+            return getattr(sys, self.file)
+        return self.file
+
+    def lines(self):
+        """Generate the lines left in the file, line breaks removed."""
+        while True:
+            line = self.target().readline()
+            if not line:
+                return
+            yield line[:-1] if line.endswith("\n") else line
+
+    def readline(self):
+        """The next line, None at the end of the input."""
+        self.target() # fails if closed
+        return next(self.source, None)
+
+    def readlines(self, count):
+        """A list of the next count lines, shorter at the end of the input."""
+        self.target()
+        return [line for _, line in zip(range(count), self.source)]
+
+    def read(self, size):
+        """The next size characters, fewer at the end, "" after it."""
+        return self.target().read(size)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Close the file unless it is one of sys's."""
+        if not self.closed:
+            self.closed = True
+            if not isinstance(self.file, str):
+                self.file.close()
+
+class AsyncInput(Input):
+    """Input from an asyncio.StreamReader, or anything with a coroutine 
+    read(size) giving bytes, decoded as UTF-8.
+    
+    Text is read ahead in blocks into buffer, reading raises Blocked with a 
+    coroutine reading the next block when the buffer does not hold what was
+    asked for yet."""
+    def __init__(self, reader, name="<async input>"):
+        super().__init__(reader, name)
+        self.buffer = ""
+        self.pos = 0 # start of what was not read yet
+        self.eof = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        
+    async def fill(self):
+        data = await self.file.read(BUFFER_SIZE)
+        text = self.decoder.decode(data, not data)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        self.eof = not data
+        
+    def wait(self, ready):
+        """Raise Blocked unless ready or there is nothing more to read."""
+        self.target() # fails if closed
+        if not ready and not self.eof:
+            raise Blocked(self.fill())
+            
+    def take(self, end):
+        text = self.buffer[self.pos:end]
+        self.pos = end
+        return text
+            
+    def readline(self):
+        end = self.buffer.find("\n", self.pos)
+        self.wait(end >= 0)
+        if end >= 0:
+            return self.take(end+1)[:-1]
+        if self.pos == len(self.buffer): # at the end
+            return None
+        return self.take(len(self.buffer))
+        
+    def readlines(self, count):
+        self.wait(self.buffer.count("\n", self.pos) >= count)
+        lines = []
+        while len(lines) < count:
+            found = self.readline()
+            if found is None:
+                break
+            lines.append(found)
+        return lines
+        
+    def read(self, size):
+        self.wait(len(self.buffer) - self.pos >= size)
+        return self.take(min(self.pos+size, len(self.buffer)))
+        
+    def close(self):
+        """Stop reading, the reader is not closed."""
+        self.closed = True
+        
+class AsyncOutput(Output):
+    """Output to an asyncio.StreamWriter, encoded as UTF-8.
+    
+    Buffered like Output, but written out without waiting for the transport.
+    While more than size characters written out are still waiting to be sent,
+    write raises Blocked with the writer's drain."""
+    def __init__(self, writer, size=BUFFER_SIZE, name="<async output>"):
+        super().__init__(writer, size, name)
+        
+    def target(self):
+        return self.file
+        
+    def write(self, text):
+        if not self.closed and \
+           self.file.transport.get_write_buffer_size() > self.size:
+            raise Blocked(self.file.drain())
+        super().write(text)
+        
+    def flush(self):
+        if self.parts:
+            self.file.write("".join(self.parts).encode("utf-8"))
+            self.parts.clear()
+            self.pending = 0
+            
+    async def drain(self):
+        """Wait until what was written out has been sent."""
+        self.flush()
+        await self.file.drain()
+        
+def open_input(path):
+    """Input from the file at path."""
+    return Input(open(path, "r", encoding="utf-8"), path)
+
+def open_output(path, mode="w", size=BUFFER_SIZE):
+    """Output to the file at path, mode is "w" (truncate) or "a" (append)."""
+    if mode not in ("w", "a"):
+        raise ValueError("Can not open a file for output with mode "+
+                         repr(mode))
+    return Output(open(path, mode, encoding="utf-8"), size, path)